@@ -1,16 +1,42 @@
 # backend/app.py
 
 import os
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash, g, stream_with_context, has_request_context, send_file, abort, appcontext_pushed
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func # For sum and count aggregates
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy import func, bindparam, text, create_engine, inspect # For sum and count aggregates
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.engine import Engine, make_url
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from datetime import datetime, timedelta # Added timedelta for active user check
 import uuid # For generating referral codes
 from functools import wraps # For login_required decorator
+import threading # For the write-behind tap accumulator
+import atexit
+import time
+import bisect # For the in-memory leaderboard ranking
+import hashlib
+import json
+import csv # For the streaming withdrawal export
+import io
+import socket
+import click
+import sqlite3 # For per-connection SQLite pragmas
+import multiprocessing
+import gzip # For precompressed static assets
+import mimetypes
+import signal # For the pre-fork production server
+from werkzeug.serving import make_server
+from werkzeug.middleware.proxy_fix import ProxyFix # Client IPs behind TRUSTED_PROXY_COUNT reverse proxies
+from itsdangerous import URLSafeSerializer, BadSignature # Opaque pagination cursors
+import random # For the synthetic data generator
+import queue
+import zlib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
-app = Flask(__name__, template_folder=
-    "../templates", static_folder="../static")
+app = Flask(__name__, template_folder=os.environ.get(
+    "TEMPLATE_FOLDER", "../templates"), static_folder=os.environ.get("STATIC_FOLDER", "../static"))
 
 # Configuration
 app.config["SECRET_KEY"] = os.environ.get(
@@ -18,8 +44,110 @@ app.config["SECRET_KEY"] = os.environ.get(
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
     "DATABASE_URL", "sqlite:///criptomain.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Engine profile: SQLite gets WAL/pragmas on connect, server databases get pool sizing.
+# READ_DATABASE_URL (a replica, or a second SQLite connection pool) serves the read-only report routes.
+app.config["SQLITE_JOURNAL_MODE"] = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+app.config["SQLITE_SYNCHRONOUS"] = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+app.config["SQLITE_BUSY_TIMEOUT_MS"] = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+app.config["SQLITE_MMAP_SIZE"] = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+# Pool sizing only applies to server databases; configure_app() turns these into SQLALCHEMY_ENGINE_OPTIONS
+app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 10))
+app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+app.config["DB_POOL_TIMEOUT"] = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+app.config["DB_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+app.config["READ_DATABASE_URL"] = os.environ.get("READ_DATABASE_URL")
+# Tap batching: pending taps are flushed every N seconds or once this many users are buffered
+app.config["TAP_FLUSH_INTERVAL_SECONDS"] = float(os.environ.get("TAP_FLUSH_INTERVAL_SECONDS", 2.0))
+app.config["TAP_FLUSH_MAX_USERS"] = int(os.environ.get("TAP_FLUSH_MAX_USERS", 500))
+# Client sequence numbers are remembered in memory this long; older ones are looked up on the ledger
+app.config["TAP_SEQ_TTL_SECONDS"] = float(os.environ.get("TAP_SEQ_TTL_SECONDS", 600.0))
+app.config["TAP_MAX_BATCH"] = int(os.environ.get("TAP_MAX_BATCH", 1000)) # Max taps in one /api/record_taps call (see max_tap_batch)
+# How often a worker probes the settings version row before trusting its cached GlobalSetting values
+app.config["SETTINGS_CACHE_CHECK_INTERVAL_SECONDS"] = float(os.environ.get("SETTINGS_CACHE_CHECK_INTERVAL_SECONDS", 1.0))
+# The in-memory leaderboard picks up other processes' changes this often (in the background), reading only
+# users and ledger entries past the ones it has already seen
+app.config["LEADERBOARD_REFRESH_SECONDS"] = float(os.environ.get("LEADERBOARD_REFRESH_SECONDS", 5.0))
+# Rows younger than this are read again on the next refresh, in case a concurrent transaction commits lower ids later
+app.config["LEADERBOARD_SETTLE_SECONDS"] = float(os.environ.get("LEADERBOARD_SETTLE_SECONDS", 10.0))
+app.config["LEADERBOARD_MAX_LIMIT"] = 100
+# Hourly dashboard buckets older than this are dropped by the reconciliation job
+app.config["STATS_BUCKET_RETENTION_DAYS"] = int(os.environ.get("STATS_BUCKET_RETENTION_DAYS", 40))
+# Raw TokenPriceHistory rows older than this are compacted into hourly TokenPriceRollup rows
+app.config["PRICE_HISTORY_RAW_RETENTION_DAYS"] = int(os.environ.get("PRICE_HISTORY_RAW_RETENTION_DAYS", 7))
+# Server-Sent Events: keepalive period, price poll period for changes made by other workers, and connection caps
+app.config["SSE_KEEPALIVE_SECONDS"] = float(os.environ.get("SSE_KEEPALIVE_SECONDS", 15.0))
+app.config["SSE_PRICE_POLL_SECONDS"] = float(os.environ.get("SSE_PRICE_POLL_SECONDS", 2.0))
+app.config["SSE_MAX_STREAMS_PER_USER"] = int(os.environ.get("SSE_MAX_STREAMS_PER_USER", 3))
+app.config["SSE_MAX_STREAMS"] = int(os.environ.get("SSE_MAX_STREAMS", 1000))
+app.config["WITHDRAWAL_BULK_CHUNK_SIZE"] = 500 # Ids per statement in bulk withdrawal actions
+# Withdrawal requests are queued as jobs for `flask run-worker`; bulk admin actions above the threshold are queued too
+app.config["WITHDRAWALS_VIA_QUEUE"] = os.environ.get("WITHDRAWALS_VIA_QUEUE", "1") == "1"
+app.config["WITHDRAWAL_BULK_ASYNC_THRESHOLD"] = int(os.environ.get("WITHDRAWAL_BULK_ASYNC_THRESHOLD", 2000))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+app.config["JOB_LOCK_TIMEOUT_SECONDS"] = int(os.environ.get("JOB_LOCK_TIMEOUT_SECONDS", 300))
+# Requests slower than this are logged with their SQL counts; METRICS_TOKEN (if set) protects /metrics
+app.config["SLOW_REQUEST_SECONDS"] = float(os.environ.get("SLOW_REQUEST_SECONDS", 0.5))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+app.config["REFERRAL_TEAM_MAX_DEPTH"] = int(os.environ.get("REFERRAL_TEAM_MAX_DEPTH", 10))
+app.config["REFERRAL_TEAM_MAX_MEMBERS"] = 200
+# Ledger: entries older than the lag are folded into balance snapshots; folded tap credits older
+# than the retention window are deleted (their effect lives on in the snapshot)
+app.config["LEDGER_SNAPSHOT_LAG_SECONDS"] = int(os.environ.get("LEDGER_SNAPSHOT_LAG_SECONDS", 60))
+app.config["LEDGER_TAP_RETENTION_DAYS"] = int(os.environ.get("LEDGER_TAP_RETENTION_DAYS", 7))
+# Tap rate limits (token buckets, in taps): refill rate per second and burst size, per user and per client IP.
+# TAP_RATE_LIMIT_BACKEND: "memory" (per process), "database" (shared RateLimitBucket table) or
+# "sqlite" (shared SQLite file at TAP_RATE_LIMIT_SQLITE_PATH, for several workers on one host)
+app.config["TAP_RATE_LIMIT_ENABLED"] = os.environ.get("TAP_RATE_LIMIT_ENABLED", "1") == "1"
+app.config["TAP_RATE_USER_PER_SECOND"] = float(os.environ.get("TAP_RATE_USER_PER_SECOND", 1.0))
+app.config["TAP_RATE_USER_BURST"] = float(os.environ.get("TAP_RATE_USER_BURST", 60))
+app.config["TAP_RATE_IP_PER_SECOND"] = float(os.environ.get("TAP_RATE_IP_PER_SECOND", 20.0))
+app.config["TAP_RATE_IP_BURST"] = float(os.environ.get("TAP_RATE_IP_BURST", 600))
+app.config["TAP_RATE_LIMIT_BACKEND"] = os.environ.get("TAP_RATE_LIMIT_BACKEND", "memory")
+app.config["TAP_RATE_LIMIT_SQLITE_PATH"] = os.environ.get("TAP_RATE_LIMIT_SQLITE_PATH", "ratelimit.db")
+# Number of reverse proxies in front of the app whose X-Forwarded-For/-Proto are trusted (ProxyFix). Without
+# it, request.remote_addr is the proxy and every player behind it shares one per-IP tap bucket.
+app.config["TRUSTED_PROXY_COUNT"] = int(os.environ.get("TRUSTED_PROXY_COUNT", 0))
+# Password hashing runs on a process pool (0 workers = inline). PASSWORD_HASH_METHOD uses Werkzeug's
+# "method:params" format; stored hashes with a different method or cost are rehashed on the next login.
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+app.config["PASSWORD_HASH_MAX_PENDING"] = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64)) # Beyond this, logins get a 503
+app.config["PASSWORD_HASH_TIMEOUT_SECONDS"] = float(os.environ.get("PASSWORD_HASH_TIMEOUT_SECONDS", 10.0))
+# Static assets are copied to content-hashed names (plus .gz variants) in ASSET_BUILD_FOLDER at startup
+# and served from /assets/ with a one-year immutable Cache-Control
+app.config["ASSET_BUILD_FOLDER"] = os.environ.get("ASSET_BUILD_FOLDER", os.path.join(app.instance_path, "assets"))
+app.config["ASSET_MAX_AGE_SECONDS"] = int(os.environ.get("ASSET_MAX_AGE_SECONDS", 365 * 24 * 3600))
+app.config["ASSET_GZIP_MIN_BYTES"] = int(os.environ.get("ASSET_GZIP_MIN_BYTES", 512))
+# Admin lists use keyset pagination; filtered totals are counted at most once per this many seconds
+app.config["ADMIN_PAGE_SIZE"] = 15
+app.config["ADMIN_COUNT_CACHE_SECONDS"] = float(os.environ.get("ADMIN_COUNT_CACHE_SECONDS", 60.0))
+# When set, registrations and taps are appended to this JSON-lines file for `flask replay-events`
+app.config["EVENT_LOG_PATH"] = os.environ.get("EVENT_LOG_PATH")
 
-db = SQLAlchemy(app)
+TAPS_PER_TOKEN = 100
+MICRO_PER_TOKEN = 1000000 # Ledger amounts are integer micro-tokens
+MICRO_PER_TAP = MICRO_PER_TOKEN // TAPS_PER_TOKEN
+
+class RoutingSession(FlaskSQLAlchemySession):
+    # Sends plain SELECTs to the "read" bind during requests marked with @use_read_replica;
+    # flushes, DML and textual statements always use the primary engine.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and clause is not None and getattr(clause, "is_select", False)
+                and has_request_context() and g.get("_use_read_replica") and "read" in self._db.engines):
+            return self._db.engines["read"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={"class_": RoutingSession}) # Bound to the app in configure_app()
+
+@db.event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+        cursor.close()
 
 # --- Database Models (based on technical_design_advanced.md) ---
 
@@ -27,7 +155,8 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(256), nullable=False)
+    password_hash = db.deferred(db.Column(db.String(256), nullable=False)) # Only loaded when a password is checked
+    # Materialized from the ledger by `flask snapshot-ledger`; live balances come from ledger_balances()
     cripto_main_tokens = db.Column(db.Float, default=0.0, nullable=False)
     taps_for_next_token = db.Column(db.Integer, default=0, nullable=False)
     referral_code = db.Column(db.String(36), unique=True, nullable=True)
@@ -48,6 +177,10 @@ class User(db.Model):
     selected_click_animation = db.Column(db.String(50), default="default", nullable=True) # e.g., "default", "ripple", "sparkle"
     sound_effects_enabled = db.Column(db.Boolean, default=True) # For UI sounds
 
+    # Denormalized referral counters, maintained in register() and by `flask rebuild-referrals`
+    referral_count = db.Column(db.Integer, default=0, nullable=False) # Direct referrals
+    downline_count = db.Column(db.Integer, default=0, nullable=False) # Referrals at every depth
+
     withdrawal_requests = db.relationship(
         "WithdrawalRequest", backref="user", lazy=True)
     referrals_made = db.relationship(
@@ -57,11 +190,20 @@ class User(db.Model):
         "Referral", foreign_keys="Referral.referred_user_id",
         backref="referred_user", uselist=False)
 
+    __table_args__ = (db.Index("ix_user_referral_count_id", "referral_count", "id"),
+                      db.Index("ix_user_created_at_id", "created_at", "id"),
+                      db.Index("ix_user_last_login_at", "last_login_at")) # Login buckets in reconcile_admin_stats
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # Upgrades the stored hash when PASSWORD_HASH_METHOD changed; the caller commits
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_needs_rehash(self.password_hash):
+            self.password_hash = password_hasher.hash(password)
+        return True
 
     def generate_referral_code(self):
         if not self.referral_code:
@@ -82,6 +224,16 @@ class TokenPriceHistory(db.Model):
     price_usd = db.Column(db.Float, nullable=False)
     reason = db.Column(db.String(255), nullable=True)
 
+class TokenPriceRollup(db.Model):
+    # Hourly OHLC aggregate of TokenPriceHistory rows that were compacted out of the raw table
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime, unique=True, nullable=False)
+    open_usd = db.Column(db.Float, nullable=False)
+    high_usd = db.Column(db.Float, nullable=False)
+    low_usd = db.Column(db.Float, nullable=False)
+    close_usd = db.Column(db.Float, nullable=False)
+    samples = db.Column(db.Integer, default=0, nullable=False)
+
 class WithdrawalRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
@@ -89,6 +241,7 @@ class WithdrawalRequest(db.Model):
     global_price_at_withdrawal = db.Column(db.Float, nullable=False)
     personal_bonus_at_withdrawal = db.Column(db.Float, nullable=False)
     total_usd_value_before_commission = db.Column(db.Float, nullable=False)
+    tokens_to_withdraw_micro = db.Column(db.BigInteger, nullable=True) # Exact amount debited from the ledger
     commission_percentage = db.Column(db.Float, nullable=False, default=0.40)
     commission_amount_usd = db.Column(db.Float, nullable=False)
     amount_to_user_usd = db.Column(db.Float, nullable=False)
@@ -99,6 +252,55 @@ class WithdrawalRequest(db.Model):
     requested_at = db.Column(db.DateTime, default=datetime.utcnow)
     processed_at = db.Column(db.DateTime, nullable=True)
     admin_notes = db.Column(db.Text, nullable=True)
+    # Admin list per status and unfiltered (status=all), and a user's own history via User.withdrawal_requests
+    __table_args__ = (db.Index("ix_withdrawal_request_status_requested_at_id", "status", "requested_at", "id"),
+                      db.Index("ix_withdrawal_request_requested_at_id", "requested_at", "id"),
+                      db.Index("ix_withdrawal_request_user_id_requested_at", "user_id", "requested_at"))
+
+class Job(db.Model):
+    # Durable work queue stored in the main database; claimed and run by `flask run-worker`
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False) # JSON
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)
+    status = db.Column(db.String(20), default="queued", nullable=False) # queued, running, done, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    result = db.Column(db.Text, nullable=True) # JSON
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index("ix_job_status_run_after", "status", "run_after"),)
+
+class LedgerEntry(db.Model):
+    # Append-only record of every balance change, in integer micro-tokens.
+    # kind: tap_credit (MICRO_PER_TAP per tap), withdrawal_debit (negative), withdrawal_refund
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    kind = db.Column(db.String(30), nullable=False)
+    amount_micro = db.Column(db.BigInteger, nullable=False)
+    # WithdrawalRequest.id for debits and refunds; the batch's last client seq for tap credits
+    reference_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (db.Index("ix_ledger_entry_user_id_id", "user_id", "id"),
+                      db.Index("ix_ledger_entry_kind_created_at", "kind", "created_at")) # Tap credit compaction
+
+class BalanceSnapshot(db.Model):
+    # Balance folded from LedgerEntry rows up to last_entry_id. tap_micro is the tap progress
+    # towards the next whole token (always < MICRO_PER_TOKEN); balance_micro is spendable.
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    balance_micro = db.Column(db.BigInteger, default=0, nullable=False)
+    tap_micro = db.Column(db.BigInteger, default=0, nullable=False)
+    last_entry_id = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class RateLimitBucket(db.Model):
+    # Shared token-bucket state for TAP_RATE_LIMIT_BACKEND=database/sqlite; updated_at is a Unix timestamp
+    key = db.Column(db.String(100), primary_key=True) # e.g. "user:42", "ip:203.0.113.7"
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
 
 class Referral(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -107,19 +309,95 @@ class Referral(db.Model):
     referred_user_id = db.Column(db.Integer, db.ForeignKey(
         "user.id"), nullable=False, unique=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # User.referrals_made and the distinct-referrer count in reconcile_admin_stats
+    __table_args__ = (db.Index("ix_referral_referrer_user_id_created_at", "referrer_user_id", "created_at"),)
+
+class AdminStat(db.Model):
+    # Running totals for the admin dashboard, maintained by the events that change them
+    id = db.Column(db.Integer, primary_key=True)
+    stat_name = db.Column(db.String(100), unique=True, nullable=False)
+    value = db.Column(db.Float, default=0.0, nullable=False)
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow,
+                             onupdate=datetime.utcnow)
+
+class StatBucket(db.Model):
+    # Hourly counters for time-windowed dashboard figures (new users, users by last login hour)
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(50), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Integer, default=0, nullable=False)
+    __table_args__ = (db.UniqueConstraint("metric", "bucket_start"),)
+
+class ReferralClosure(db.Model):
+    # One row per (ancestor, descendant) pair in the referral tree, so subtree queries are index scans
+    ancestor_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False) # 1 = direct referral
 
 # --- Helper Functions for Global Settings ---
+SETTINGS_VERSION_KEY = "settings_version" # Bumped on every write so other workers notice stale caches
+
+class SettingsCache:
+    """Process-local copy of every GlobalSetting row, reloaded when the version row changes."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._values = None # setting_name -> (float, int, str)
+        self._version = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def get(self, name):
+        return self._current().get(name)
+
+    def _current(self):
+        now = time.monotonic()
+        with self._lock:
+            values, version, checked_at = self._values, self._version, self._checked_at
+        if values is not None:
+            if now - checked_at < self.app.config["SETTINGS_CACHE_CHECK_INTERVAL_SECONDS"]:
+                return values
+            if self._probe_version() == version:
+                with self._lock:
+                    self._checked_at = now
+                return values
+        values = {s.setting_name: (s.setting_value_float, s.setting_value_int, s.setting_value_str)
+                  for s in GlobalSetting.query.all()}
+        version = values.get(SETTINGS_VERSION_KEY, (None, None, None))[1]
+        with self._lock:
+            self._values, self._version, self._checked_at = values, version, now
+        return values
+
+    def _probe_version(self):
+        return db.session.query(GlobalSetting.setting_value_int)\
+                         .filter_by(setting_name=SETTINGS_VERSION_KEY).scalar()
+
+settings_cache = SettingsCache(app)
+
 def get_global_setting(name, default=None, type_cast=float):
-    setting = GlobalSetting.query.filter_by(setting_name=name).first()
+    setting = settings_cache.get(name)
     if setting:
-        if type_cast == float and setting.setting_value_float is not None:
-            return setting.setting_value_float
-        if type_cast == int and setting.setting_value_int is not None:
-            return setting.setting_value_int
-        if type_cast == str and setting.setting_value_str is not None:
-            return setting.setting_value_str
+        value_float, value_int, value_str = setting
+        if type_cast == float and value_float is not None:
+            return value_float
+        if type_cast == int and value_int is not None:
+            return value_int
+        if type_cast == str and value_str is not None:
+            return value_str
     return default
 
+def bump_settings_version():
+    # Adds the version increment to the current transaction; the caller commits
+    version = GlobalSetting.query.filter_by(setting_name=SETTINGS_VERSION_KEY).first()
+    if not version:
+        db.session.add(GlobalSetting(setting_name=SETTINGS_VERSION_KEY, setting_value_int=1))
+    else:
+        version.setting_value_int = GlobalSetting.setting_value_int + 1
+
 def set_global_setting(name, value):
     setting = GlobalSetting.query.filter_by(setting_name=name).first()
     if not setting:
@@ -133,7 +411,1750 @@ def set_global_setting(name, value):
         setting.setting_value_str = value
     else:
         raise ValueError("Unsupported type for global setting")
+    bump_settings_version()
+    db.session.commit()
+    settings_cache.invalidate()
+
+def increment_total_users_and_reprice():
+    # Runs inside the caller's transaction. The counter UPDATE locks the total_users row
+    # until commit, so concurrent sign-ups see consecutive totals and write prices in order.
+    settings = GlobalSetting.__table__
+    increment_stmt = settings.update().where(settings.c.setting_name == "total_users")\
+                             .values(setting_value_int=settings.c.setting_value_int + 1)
+    if db.engine.dialect.update_returning:
+        total_users = db.session.execute(increment_stmt.returning(settings.c.setting_value_int)).scalar_one()
+    else:
+        db.session.execute(increment_stmt)
+        total_users = db.session.query(GlobalSetting.setting_value_int).filter_by(setting_name="total_users").scalar()
+    initial_price = get_global_setting("initial_token_price_usd")
+    increment = get_global_setting("price_increment_per_user_usd")
+    new_global_price = initial_price + (total_users * increment)
+    db.session.execute(settings.update().where(settings.c.setting_name == "current_global_token_price_usd")
+                               .values(setting_value_float=new_global_price))
+    bump_settings_version()
+    return total_users, new_global_price
+
+# --- Token Ledger ---
+def to_micro(tokens):
+    return int(round(tokens * MICRO_PER_TOKEN))
+
+def _ledger_balance_columns(up_to_id=None, user_ids=None):
+    # Per-user (balance_micro, tap_micro) as SQL: snapshot (or the legacy User columns when a user has
+    # no snapshot yet) plus the ledger tail after it. Whole tokens minted by taps move into the balance.
+    users = User.__table__
+    snapshots = BalanceSnapshot.__table__
+    entries = LedgerEntry.__table__
+    is_tap = entries.c.kind == "tap_credit"
+    tail = db.select(entries.c.user_id,
+                     func.sum(db.case((is_tap, entries.c.amount_micro), else_=0)).label("tap_micro"),
+                     func.sum(db.case((is_tap, 0), else_=entries.c.amount_micro)).label("other_micro"),
+                     func.max(entries.c.id).label("last_entry_id"))\
+             .select_from(entries.outerjoin(snapshots, snapshots.c.user_id == entries.c.user_id))\
+             .where(entries.c.id > func.coalesce(snapshots.c.last_entry_id, 0))
+    if up_to_id is not None:
+        tail = tail.where(entries.c.id <= up_to_id)
+    if user_ids is not None:
+        tail = tail.where(entries.c.user_id.in_(user_ids)) # Keeps the tail on ix_ledger_entry_user_id_id
+    tail = tail.group_by(entries.c.user_id).subquery()
+    base_balance = func.coalesce(snapshots.c.balance_micro,
+                                 db.cast(func.round(users.c.cripto_main_tokens * MICRO_PER_TOKEN), db.BigInteger))
+    tap_total = func.coalesce(snapshots.c.tap_micro, users.c.taps_for_next_token * MICRO_PER_TAP)\
+        + func.coalesce(tail.c.tap_micro, 0)
+    balance = base_balance + (tap_total // MICRO_PER_TOKEN) * MICRO_PER_TOKEN + func.coalesce(tail.c.other_micro, 0)
+    from_clause = users.outerjoin(snapshots, snapshots.c.user_id == users.c.id)\
+                       .outerjoin(tail, tail.c.user_id == users.c.id)
+    return from_clause, balance.label("balance_micro"), (tap_total % MICRO_PER_TOKEN).label("tap_micro"), tail
+
+def ledger_balances(user_ids):
+    # {user_id: (tokens, taps_for_next_token)} in one query
+    if not user_ids:
+        return {}
+    users = User.__table__
+    user_ids = list(user_ids)
+    from_clause, balance, tap_micro, _ = _ledger_balance_columns(user_ids=user_ids)
+    rows = db.session.execute(db.select(users.c.id, balance, tap_micro).select_from(from_clause)
+                                .where(users.c.id.in_(user_ids))).all()
+    return {uid: (balance_micro / MICRO_PER_TOKEN, int(tap // MICRO_PER_TAP)) for uid, balance_micro, tap in rows}
+
+def ledger_total_micro():
+    from_clause, balance, _, _ = _ledger_balance_columns()
+    total = db.session.execute(db.select(func.sum(balance)).select_from(from_clause)).scalar()
+    return total or 0
+
+def append_ledger_entry(user_id, kind, amount_micro, reference_id=None):
+    # Adds the entry to the current transaction; the caller commits
+    db.session.execute(LedgerEntry.__table__.insert().values(
+        user_id=user_id, kind=kind, amount_micro=amount_micro, reference_id=reference_id,
+        created_at=datetime.utcnow()))
+
+def snapshot_ledger():
+    # Folds settled ledger entries into BalanceSnapshot, materializes User.cripto_main_tokens/
+    # taps_for_next_token for the admin lists, then compacts old tap credits.
+    now = datetime.utcnow()
+    cutoff_id = db.session.query(func.max(LedgerEntry.id))\
+                          .filter(LedgerEntry.created_at < now - timedelta(seconds=app.config["LEDGER_SNAPSHOT_LAG_SECONDS"]))\
+                          .scalar()
+    if not cutoff_id:
+        return 0
+    users = User.__table__
+    from_clause, balance, tap_micro, tail = _ledger_balance_columns(up_to_id=cutoff_id)
+    rows = db.session.execute(db.select(users.c.id, balance, tap_micro, tail.c.last_entry_id)
+                                .select_from(from_clause).where(tail.c.last_entry_id.isnot(None))).all()
+    existing = {s.user_id: s for s in BalanceSnapshot.query.filter(
+        BalanceSnapshot.user_id.in_([r.id for r in rows]))} if rows else {}
+    for user_id, balance_micro, tap, last_entry_id in rows:
+        snapshot = existing.get(user_id)
+        if not snapshot:
+            snapshot = BalanceSnapshot(user_id=user_id)
+            db.session.add(snapshot)
+        snapshot.balance_micro = balance_micro
+        snapshot.tap_micro = tap
+        snapshot.last_entry_id = last_entry_id
+    if rows:
+        db.session.execute(users.update().where(users.c.id == bindparam("uid")).values(
+            cripto_main_tokens=bindparam("tokens"), taps_for_next_token=bindparam("taps")),
+            [{"uid": r.id, "tokens": r.balance_micro / MICRO_PER_TOKEN, "taps": int(r.tap_micro // MICRO_PER_TAP)}
+             for r in rows])
+    db.session.flush()
+    retention_start = now - timedelta(days=app.config["LEDGER_TAP_RETENTION_DAYS"])
+    folded_up_to = db.select(BalanceSnapshot.last_entry_id)\
+                     .where(BalanceSnapshot.user_id == LedgerEntry.user_id).scalar_subquery()
+    LedgerEntry.query.filter(LedgerEntry.kind == "tap_credit", LedgerEntry.created_at < retention_start,
+                             LedgerEntry.id <= folded_up_to).delete(synchronize_session=False)
+    db.session.commit()
+    return len(rows)
+
+@app.cli.command("snapshot-ledger")
+def snapshot_ledger_command():
+    """Fold ledger entries into balance snapshots and compact old tap credits (run every minute or so)."""
+    count = snapshot_ledger()
+    print(f"Snapshotted {count} balances.")
+
+# --- Tap Accumulator (write-behind) ---
+def project_tap_state(tokens, taps, pending_taps):
+    # Applies pending taps on top of a stored balance using the 100-taps-per-token conversion
+    total_taps = taps + pending_taps
+    return tokens + total_taps // TAPS_PER_TOKEN, total_taps % TAPS_PER_TOKEN
+
+class TapAccumulator:
+    """Merges taps per user in memory and appends them to the ledger in bulk.
+
+    Retried batches are rejected by client sequence number. The last accepted seq is kept in memory
+    for TAP_SEQ_TTL_SECONDS and written on the tap_credit ledger row when the batch is flushed, so a
+    retry that reaches another worker is caught once the first worker has flushed. A retry landing on
+    another worker within TAP_FLUSH_INTERVAL_SECONDS of the original is still credited: best-effort.
+
+    The settled ledger balance of each user tapping here is cached too, so a tap reads the database only
+    when the user is first seen. Every flush refreshes it from the balances the flush reads anyway and
+    drops users who stopped tapping, so a change made elsewhere (another worker) shows within a flush or two.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._pending = {} # user_id -> taps not yet written
+        self._flushing = {} # user_id -> taps being written by a flush
+        self._pending_seq = {} # user_id -> last seq among the pending taps
+        self._last_seq = {} # user_id -> (last client sequence number accepted, monotonic time)
+        self._settled = {} # user_id -> (tokens, taps) on the ledger, without _flushing and _pending
+        self._timer = None
+
+    def _stored_seq(self, user_id):
+        return db.session.query(LedgerEntry.reference_id)\
+            .filter(LedgerEntry.user_id == user_id, LedgerEntry.kind == "tap_credit",
+                    LedgerEntry.reference_id.isnot(None))\
+            .order_by(LedgerEntry.id.desc()).limit(1).scalar()
+
+    def _settled_for(self, user_id):
+        with self._lock:
+            settled = self._settled.get(user_id)
+        if settled is None:
+            with self.app.app_context():
+                settled = ledger_balances([user_id])[user_id]
+            with self._lock:
+                settled = self._settled.setdefault(user_id, settled)
+        return settled
+
+    def balance(self, user_id):
+        # (tokens, taps_for_next_token) including the taps not written yet
+        return project_tap_state(*self._settled_for(user_id), self.pending_for(user_id))
+
+    def pending_users(self):
+        with self._lock:
+            return len(self._pending)
+
+    def pending_for(self, user_id):
+        # Taps not yet committed to the ledger
+        with self._lock:
+            return self._pending.get(user_id, 0) + self._flushing.get(user_id, 0)
+
+    def forget(self, user_ids):
+        # Balances changed outside the tap path (withdrawals, refunds) are read again on the next tap
+        with self._lock:
+            for user_id in user_ids:
+                self._settled.pop(user_id, None)
+
+    def _prune_seqs(self, now):
+        # Called with the lock held
+        cutoff = now - self.app.config["TAP_SEQ_TTL_SECONDS"]
+        self._last_seq = {uid: entry for uid, entry in self._last_seq.items() if entry[1] >= cutoff}
+
+    def add(self, user_id, count=1, seq=None):
+        # Returns False if the client sequence number was already seen (retried batch)
+        flush_now = False
+        stored = None
+        if seq is not None:
+            with self._lock:
+                known = user_id in self._last_seq
+            if not known:
+                with self.app.app_context():
+                    stored = self._stored_seq(user_id)
+        with self._lock:
+            if seq is not None:
+                last = self._last_seq[user_id][0] if user_id in self._last_seq else stored
+                if last is not None and seq <= last:
+                    return False
+                self._last_seq[user_id] = (seq, time.monotonic())
+                self._pending_seq[user_id] = seq
+            self._pending[user_id] = self._pending.get(user_id, 0) + count
+            if len(self._pending) >= self.app.config["TAP_FLUSH_MAX_USERS"]:
+                flush_now = True
+            elif self._timer is None:
+                self._timer = threading.Timer(self.app.config["TAP_FLUSH_INTERVAL_SECONDS"], self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+        return True
+
+    def flush(self, user_ids=None):
+        # Writes every buffered user's taps, or only those of user_ids (a withdrawal needs just its caller's)
+        with self._lock:
+            if user_ids is None:
+                batch, self._pending = self._pending, {}
+                seqs, self._pending_seq = self._pending_seq, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                # Users who did not tap since the last full flush leave the balance cache
+                self._settled = {uid: v for uid, v in self._settled.items() if uid in batch or uid in self._flushing}
+            else:
+                batch = {uid: self._pending.pop(uid) for uid in user_ids if uid in self._pending}
+                seqs = {uid: self._pending_seq.pop(uid) for uid in batch if uid in self._pending_seq}
+            for uid, n in batch.items():
+                self._flushing[uid] = self._flushing.get(uid, 0) + n
+            self._prune_seqs(time.monotonic())
+        if not batch:
+            return 0
+        try:
+            with self.app.app_context():
+                # Tap credits are plain ledger inserts, so flushing never rewrites the hot User rows
+                settled = {}
+                minted = 0
+                for user_id, (tokens, taps) in ledger_balances(batch).items():
+                    settled[user_id] = project_tap_state(tokens, taps, batch[user_id])
+                    minted += settled[user_id][0] - tokens
+                now = datetime.utcnow()
+                db.session.execute(LedgerEntry.__table__.insert(), [
+                    {"user_id": uid, "kind": "tap_credit", "amount_micro": n * MICRO_PER_TAP,
+                     "reference_id": seqs.get(uid), "created_at": now}
+                    for uid, n in batch.items()])
+                if minted:
+                    bump_admin_stats(tokens_in_circulation=minted)
+                db.session.commit()
+                with self._lock:
+                    self._settled.update(settled)
+                    self._done_flushing(batch)
+                leaderboard.update_many((user_id, tokens) for user_id, (tokens, _) in settled.items())
+        except Exception:
+            # Put the taps back so the next flush retries them
+            with self._lock:
+                self._done_flushing(batch)
+                for uid, n in batch.items():
+                    self._pending[uid] = self._pending.get(uid, 0) + n
+                for uid, seq in seqs.items():
+                    self._pending_seq[uid] = max(seq, self._pending_seq.get(uid, seq))
+            raise
+        return len(batch)
+
+    def _done_flushing(self, batch):
+        # Called with the lock held
+        for uid, n in batch.items():
+            left = self._flushing.get(uid, 0) - n
+            if left > 0:
+                self._flushing[uid] = left
+            else:
+                self._flushing.pop(uid, None)
+
+tap_accumulator = TapAccumulator(app)
+atexit.register(tap_accumulator.flush)
+
+# --- Tap Rate Limiting ---
+class TokenBucketLimiter:
+    """Process-local token buckets keyed by string; also the fast path in front of a shared store."""
+
+    PRUNE_AT = 10000 # Full (idle) buckets are dropped once this many keys are tracked
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {} # key -> [tokens, updated (monotonic), rate, burst]
+        self._prune_at = self.PRUNE_AT
+
+    def consume(self, key, cost, rate, burst):
+        # Returns seconds to wait before retrying, or 0 if the cost was taken from the bucket
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self._prune_at:
+                    self._prune(now)
+                bucket = self._buckets[key] = [burst, now, rate, burst]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1], bucket[2], bucket[3] = now, rate, burst
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+            return (cost - bucket[0]) / rate
+
+    def _prune(self, now):
+        self._buckets = {k: b for k, b in self._buckets.items() if b[0] + (now - b[1]) * b[2] < b[3]}
+        self._prune_at = max(self.PRUNE_AT, 2 * len(self._buckets))
+
+class SharedBucketStore:
+    """Token buckets in the RateLimitBucket table, shared by every worker using the same database."""
+
+    def __init__(self, get_engine):
+        self._get_engine = get_engine
+
+    def consume(self, key, cost, rate, burst):
+        # A single guarded UPDATE takes the cost, so concurrent workers never read-modify-write a bucket
+        buckets = RateLimitBucket.__table__
+        now = time.time()
+        refilled = buckets.c.tokens + (now - buckets.c.updated_at) * rate
+        refilled = db.case((refilled > burst, burst), else_=refilled)
+        with self._get_engine().begin() as conn:
+            taken = conn.execute(buckets.update()
+                                 .where(buckets.c.key == key, refilled >= cost)
+                                 .values(tokens=refilled - cost, updated_at=now)).rowcount
+            if taken:
+                return 0
+            tokens = conn.execute(db.select(refilled).where(buckets.c.key == key)).scalar()
+        if tokens is None:
+            try:
+                with self._get_engine().begin() as conn:
+                    conn.execute(buckets.insert().values(key=key, tokens=burst - cost, updated_at=now))
+                return 0 if burst >= cost else cost / rate
+            except IntegrityError:
+                return self.consume(key, cost, rate, burst) # Another worker created it first
+        return (cost - tokens) / rate
+
+class TapRateLimiter:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.local = TokenBucketLimiter()
+        self._shared = None
+        self._shared_lock = threading.Lock()
+
+    def shared(self):
+        backend = self.app.config["TAP_RATE_LIMIT_BACKEND"]
+        if backend == "memory":
+            return None
+        with self._shared_lock:
+            if self._shared is None:
+                if backend == "sqlite":
+                    engine = create_engine("sqlite:///" + self.app.config["TAP_RATE_LIMIT_SQLITE_PATH"])
+                    RateLimitBucket.__table__.create(engine, checkfirst=True)
+                    self._shared = SharedBucketStore(lambda: engine)
+                else:
+                    self._shared = SharedBucketStore(lambda: db.engine)
+        return self._shared
+
+    def check(self, user_id, ip, taps):
+        # Returns seconds to wait if the taps exceed the user or IP limit, else 0. The local buckets
+        # reject floods without any I/O; the shared store only sees traffic a single worker allowed.
+        config = self.app.config
+        limits = [(f"user:{user_id}", config["TAP_RATE_USER_PER_SECOND"], config["TAP_RATE_USER_BURST"]),
+                  (f"ip:{ip}", config["TAP_RATE_IP_PER_SECOND"], config["TAP_RATE_IP_BURST"])]
+        for key, rate, burst in limits:
+            retry_after = self.local.consume(key, taps, rate, burst)
+            if retry_after:
+                return retry_after
+        shared = self.shared()
+        if shared is not None:
+            for key, rate, burst in limits:
+                retry_after = shared.consume(key, taps, rate, burst)
+                if retry_after:
+                    return retry_after
+        return 0
+
+tap_rate_limiter = TapRateLimiter(app)
+
+def max_tap_batch():
+    # A batch larger than a bucket's burst could never be admitted, so it is refused up front with a 400
+    # rather than a 429 whose Retry-After would be retried forever
+    limit = app.config["TAP_MAX_BATCH"]
+    if app.config["TAP_RATE_LIMIT_ENABLED"]:
+        limit = min(limit, int(app.config["TAP_RATE_USER_BURST"]), int(app.config["TAP_RATE_IP_BURST"]))
+    return limit
+
+def tap_rate_limit_response(taps):
+    # None if the taps are allowed, else a 429 response; runs before the view touches the database
+    if not app.config["TAP_RATE_LIMIT_ENABLED"]:
+        return None
+    retry_after = tap_rate_limiter.check(session["user_id"], request.remote_addr, taps)
+    if not retry_after:
+        return None
+    response = jsonify({"success": False, "message": "Too many taps. Please slow down."})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+# --- Leaderboard ---
+class SortedList:
+    """Sorted keys held in sublists of about LOAD items, so insert and remove cost O(sqrt n) list work
+    instead of shifting one n-item list. A Fenwick tree over the sublist lengths makes rank O(log n)."""
+
+    LOAD = 1000
+
+    def __init__(self, sorted_keys=()):
+        keys = list(sorted_keys)
+        self._lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [sub[-1] for sub in self._lists]
+        self._len = len(keys)
+        self._build_tree()
+
+    def __len__(self):
+        return self._len
+
+    def _build_tree(self):
+        # Only when sublists are split or dropped, about once per LOAD inserts or removals
+        tree = [0] + [len(sub) for sub in self._lists]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, delta):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _tree_prefix(self, i):
+        # Total length of the first i sublists
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, key):
+        self._len += 1
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._build_tree()
+            return
+        i = min(bisect.bisect_left(self._maxes, key), len(self._lists) - 1)
+        sub = self._lists[i]
+        bisect.insort(sub, key)
+        self._maxes[i] = sub[-1]
+        if len(sub) > 2 * self.LOAD:
+            self._lists[i:i + 1] = [sub[:self.LOAD], sub[self.LOAD:]]
+            self._maxes[i:i + 1] = [sub[self.LOAD - 1], sub[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        sub = self._lists[i] if i < len(self._lists) else []
+        j = bisect.bisect_left(sub, key)
+        if j == len(sub) or sub[j] != key:
+            raise ValueError(f"{key!r} not in list")
+        del sub[j]
+        self._len -= 1
+        if sub:
+            self._maxes[i] = sub[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._lists[i]
+            del self._maxes[i]
+            self._build_tree()
+
+    def index(self, key):
+        # Number of keys smaller than key
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._lists):
+            return self._len
+        return self._tree_prefix(i) + bisect.bisect_left(self._lists[i], key)
+
+    def head(self, n):
+        keys = []
+        for sub in self._lists:
+            if len(keys) >= n:
+                break
+            keys.extend(sub[:n - len(keys)])
+        return keys
+
+class Leaderboard:
+    """Sorted (-tokens, user_id) keys so top-N is a prefix and rank-of-user is O(log n).
+
+    Flushes and withdrawals move players as their ledger balance changes. The first load ranks every
+    player from ledger balances; after that, every LEADERBOARD_REFRESH_SECONDS a background thread picks
+    up other processes' changes incrementally: new users past the last seen id, users with ledger entries
+    past the last seen entry, and the names of the players on the first page. Moves made while a load
+    runs are replayed on top of it.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._keys = SortedList()
+        self._tokens = {} # user_id -> balance currently in _keys
+        self._names = {}
+        self._changes = None # [(user_id, name, tokens)] made during a load; None means unchanged
+        self._rebuilding = False
+        self._loaded_at = None
+        self._seen_user_id = 0
+        self._seen_entry_id = 0 # Ledger entries up to here are reflected in _tokens
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def ensure_fresh(self):
+        # Called from request handlers. Only the very first load (normally done by warm_worker before
+        # traffic) blocks; stale rankings keep serving while a background thread refreshes them.
+        if self._loaded_at is None:
+            with self._rebuild_lock:
+                if self._loaded_at is None:
+                    self.rebuild()
+            return
+        if time.monotonic() - self._loaded_at < self.app.config["LEADERBOARD_REFRESH_SECONDS"]:
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._refresh_in_background, name="leaderboard-refresh", daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            with self.app.app_context():
+                with self._rebuild_lock:
+                    moved = self.refresh()
+            # The cross-process path for balance events: debits and refunds made by the job worker or
+            # another web worker reach this process's streams here
+            for user_id, tokens in moved.items():
+                event_hub.publish(user_id, "balance", {"cripto_main_tokens": tokens})
+        except Exception:
+            self.app.logger.exception("Leaderboard refresh failed")
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _watermark(self, model, seen_id):
+        # The newest id past seen_id that is old enough to have no uncommitted neighbours with lower ids
+        # (concurrent writers); younger rows are read again next time. Walks back from the newest row.
+        settled = datetime.utcnow() - timedelta(seconds=self.app.config["LEADERBOARD_SETTLE_SECONDS"])
+        newest = db.session.query(model.id).filter(model.id > seen_id, model.created_at < settled)\
+                           .order_by(model.id.desc()).limit(1).scalar()
+        return newest or seen_id
+
+    def rebuild(self):
+        # Full load: every player's ledger balance
+        def load():
+            users = User.__table__
+            last_user_id, watermark = self._watermark(User, 0), self._watermark(LedgerEntry, 0)
+            from_clause, balance, _, _ = _ledger_balance_columns()
+            rows = db.session.execute(db.select(users.c.id, users.c.display_name, users.c.username, balance)
+                                        .select_from(from_clause).where(users.c.is_admin.isnot(True))).all()
+            tokens = {r.id: r.balance_micro / MICRO_PER_TOKEN for r in rows}
+            names = {r.id: r.display_name or r.username for r in rows}
+            return tokens, names, last_user_id, watermark
+        tokens, names, last_user_id, watermark = self._load(load)
+        with self._lock:
+            changes, self._changes = self._changes, None
+            self._keys = SortedList(sorted((-balance_tokens, user_id) for user_id, balance_tokens in tokens.items()))
+            self._tokens, self._names = tokens, names
+            self._seen_user_id, self._seen_entry_id = last_user_id, watermark
+            self._replay(changes)
+            self._loaded_at = time.monotonic()
+
+    def refresh(self):
+        # Incremental load: only what changed since the last one, each part an index range read.
+        # Returns {user_id: tokens} for the players whose balance moved.
+        if not self.loaded:
+            self.rebuild()
+            return {}
+        def load():
+            last_user_id = self._watermark(User, self._seen_user_id)
+            watermark = self._watermark(LedgerEntry, self._seen_entry_id)
+            new_users = db.session.query(User.id, User.display_name, User.username)\
+                                  .filter(User.id > self._seen_user_id, User.is_admin.isnot(True)).all()
+            # Not DISTINCT: SQLite would then walk the whole (user_id, id) index instead of the id range
+            changed = {user_id for (user_id,) in db.session.query(LedgerEntry.user_id)
+                                                             .filter(LedgerEntry.id > self._seen_entry_id)}
+            changed.update(u.id for u in new_users)
+            balances = {uid: tokens for uid, (tokens, _) in ledger_balances(changed).items()}
+            with self._lock:
+                top_ids = [user_id for _, user_id in self._keys.head(self.app.config["LEADERBOARD_MAX_LIMIT"])]
+            names = {u.id: u.display_name or u.username for u in new_users}
+            if top_ids:
+                names.update((u.id, u.display_name or u.username) for u in db.session.query(
+                    User.id, User.display_name, User.username).filter(User.id.in_(top_ids)))
+            return balances, names, last_user_id, watermark
+        balances, names, last_user_id, watermark = self._load(load)
+        moved = {}
+        with self._lock:
+            changes, self._changes = self._changes, None
+            self._names.update(names)
+            for user_id, tokens in balances.items():
+                if user_id in self._names and self._tokens.get(user_id) != tokens:
+                    self._set(user_id, tokens)
+                    moved[user_id] = tokens
+            self._seen_user_id, self._seen_entry_id = last_user_id, watermark
+            self._replay(changes)
+            self._loaded_at = time.monotonic()
+        return moved
+
+    def _load(self, load):
+        # Runs the reads outside the lock, recording moves made meanwhile so they can be replayed
+        with self._lock:
+            self._changes = []
+        try:
+            return load()
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+
+    def _replay(self, changes):
+        for user_id, name, balance_tokens in changes:
+            if name is not None:
+                self._names[user_id] = name
+            if balance_tokens is not None and (user_id in self._tokens or name is not None):
+                self._set(user_id, balance_tokens)
+
+    def add(self, user_id, name, tokens=0.0):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((user_id, name, tokens))
+            if not self.loaded:
+                return
+            self._names[user_id] = name
+            self._set(user_id, tokens)
+
+    def update_many(self, balances):
+        # Only users already ranked are moved; new users arrive through add() or the next refresh
+        with self._lock:
+            for user_id, tokens in balances:
+                if self._changes is not None:
+                    self._changes.append((user_id, None, tokens))
+                if user_id in self._tokens:
+                    self._set(user_id, tokens)
+
+    def rename(self, user_id, name):
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((user_id, name, None))
+            if user_id in self._names:
+                self._names[user_id] = name
+
+    def _set(self, user_id, tokens):
+        old = self._tokens.get(user_id)
+        if old is not None:
+            self._keys.remove((-old, user_id))
+        self._keys.add((-tokens, user_id))
+        self._tokens[user_id] = tokens
+
+    def top(self, limit):
+        with self._lock:
+            return [{"rank": i + 1, "name": self._names.get(uid), "cripto_main_tokens": -neg}
+                    for i, (neg, uid) in enumerate(self._keys.head(limit))]
+
+    def rank(self, user_id):
+        with self._lock:
+            tokens = self._tokens.get(user_id)
+            if tokens is None:
+                return None
+            return self._keys.index((-tokens, user_id)) + 1
+
+    def __len__(self):
+        return len(self._keys)
+
+leaderboard = Leaderboard(app)
+
+# --- Live Event Stream (SSE) ---
+class StreamSubscriber:
+    """One connected stream. Holds only the latest payload per event type, so a slow
+    consumer never queues more than one pending message per type (older ones are coalesced)."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        self._pending = {}
+        self.closed = False
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def offer(self, event, data):
+        with self._cond:
+            if event in self._pending:
+                self.coalesced += 1
+            self._pending[event] = data
+            self._cond.notify()
+
+    def drain(self, timeout):
+        # Returns None once the stream has been closed by the server
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            if self.closed:
+                return None
+            events, self._pending = self._pending, {}
+        return events
+
+class EventHub:
+    """Fans balance and price events out to the streams connected to this process."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._subscribers = {} # user_id -> set of StreamSubscriber
+        self._count = 0
+        self._last_price = None
+        self._poller = None
+
+    def subscribe(self, user_id):
+        with self._lock:
+            streams = self._subscribers.setdefault(user_id, set())
+            if len(streams) >= self.app.config["SSE_MAX_STREAMS_PER_USER"] or self._count >= self.app.config["SSE_MAX_STREAMS"]:
+                return None
+            subscriber = StreamSubscriber(user_id)
+            streams.add(subscriber)
+            self._count += 1
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_price, daemon=True)
+                self._poller.start()
+        return subscriber
+
+    def stream_count(self):
+        with self._lock:
+            return self._count
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            streams = self._subscribers.get(subscriber.user_id)
+            if streams and subscriber in streams:
+                streams.discard(subscriber)
+                self._count -= 1
+                if not streams:
+                    del self._subscribers[subscriber.user_id]
+
+    def publish(self, user_id, event, data):
+        with self._lock:
+            streams = list(self._subscribers.get(user_id, ()))
+        for subscriber in streams:
+            subscriber.offer(event, data)
+
+    def publish_price(self, price):
+        with self._lock:
+            if price == self._last_price:
+                return
+            self._last_price = price
+            streams = [sub for subs in self._subscribers.values() for sub in subs]
+        for subscriber in streams:
+            subscriber.offer("price", {"current_global_token_price_usd": price})
+
+    def close_all(self):
+        # Ends every open stream (graceful shutdown); EventSource clients reconnect to another worker
+        with self._lock:
+            streams = [sub for subs in self._subscribers.values() for sub in subs]
+        for subscriber in streams:
+            subscriber.close()
+
+    def _poll_price(self):
+        # One settings-cache read per process per interval picks up prices changed by other workers; the
+        # leaderboard refresh it triggers publishes balances changed by other processes (see Leaderboard.refresh)
+        while True:
+            time.sleep(self.app.config["SSE_PRICE_POLL_SECONDS"])
+            with self._lock:
+                if not self._count:
+                    self._poller = None
+                    return
+            with self.app.app_context():
+                price = get_global_setting("current_global_token_price_usd")
+                leaderboard.ensure_fresh()
+            self.publish_price(price)
+
+event_hub = EventHub(app)
+
+def sse_frame(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def publish_balances(user_ids):
+    # Moves the users on this process's leaderboard and pushes their balance to their open streams.
+    # Other processes see the change on their next leaderboard refresh, which reads the ledger tail
+    # (at most LEADERBOARD_REFRESH_SECONDS later while a stream or leaderboard page is open).
+    balances = {user_id: tokens for user_id, (tokens, _) in ledger_balances(user_ids).items()}
+    tap_accumulator.forget(balances)
+    leaderboard.update_many(balances.items())
+    for user_id, tokens in balances.items():
+        event_hub.publish(user_id, "balance", {"cripto_main_tokens": tokens})
+    return balances
+
+def mark_balances_changed(user_ids):
+    # For code that does not commit itself (job handlers): published after commit_balance_changes() commits
+    db.session.info.setdefault("changed_balances", set()).update(user_ids)
+
+def commit_balance_changes():
     db.session.commit()
+    changed = db.session.info.pop("changed_balances", None)
+    if changed:
+        publish_balances(changed)
+
+# --- Admin Statistics ---
+ADMIN_STAT_NAMES = ("tokens_in_circulation", "pending_withdrawals_count", "total_usd_pending_withdrawal",
+                    "total_usd_paid_out", "total_admin_commission", "total_referrals", "referrers_count")
+
+def _hour_bucket(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def bump_admin_stats(**deltas):
+    # Adds the increments to the current transaction; the caller commits
+    for name, delta in deltas.items():
+        AdminStat.query.filter_by(stat_name=name)\
+                       .update({AdminStat.value: AdminStat.value + delta}, synchronize_session=False)
+
+def bump_stat_bucket(metric, ts, delta=1):
+    bucket_start = _hour_bucket(ts)
+    updated = StatBucket.query.filter_by(metric=metric, bucket_start=bucket_start)\
+                              .update({StatBucket.value: StatBucket.value + delta}, synchronize_session=False)
+    if updated or delta < 0:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(StatBucket(metric=metric, bucket_start=bucket_start, value=delta))
+    except IntegrityError:
+        # Another transaction created the bucket first
+        StatBucket.query.filter_by(metric=metric, bucket_start=bucket_start)\
+                        .update({StatBucket.value: StatBucket.value + delta}, synchronize_session=False)
+
+def record_login_stats(previous_login_at, login_at):
+    # Each user is counted once, in the bucket of their most recent login
+    if previous_login_at:
+        bump_stat_bucket("last_login", previous_login_at, -1)
+    bump_stat_bucket("last_login", login_at, 1)
+
+def reconcile_admin_stats():
+    # Recomputes every dashboard counter from the source tables
+    now = datetime.utcnow()
+    totals = {
+        "tokens_in_circulation": ledger_total_micro() / MICRO_PER_TOKEN,
+        "pending_withdrawals_count": WithdrawalRequest.query.filter_by(status="pending").count(),
+        "total_usd_pending_withdrawal": db.session.query(func.sum(WithdrawalRequest.amount_to_user_usd)).filter_by(status="pending").scalar() or 0.0,
+        "total_usd_paid_out": db.session.query(func.sum(WithdrawalRequest.amount_to_user_usd)).filter_by(status="processed").scalar() or 0.0,
+        "total_admin_commission": db.session.query(func.sum(WithdrawalRequest.commission_amount_usd)).filter_by(status="processed").scalar() or 0.0,
+        "total_referrals": Referral.query.count(),
+        "referrers_count": db.session.query(func.count(func.distinct(Referral.referrer_user_id))).scalar() or 0,
+    }
+    existing = {stat.stat_name: stat for stat in AdminStat.query.all()}
+    for name, value in totals.items():
+        stat = existing.get(name)
+        if not stat:
+            stat = AdminStat(stat_name=name)
+            db.session.add(stat)
+        stat.value = float(value)
+
+    window_start = _hour_bucket(now - timedelta(days=app.config["STATS_BUCKET_RETENTION_DAYS"]))
+    counts = {}
+    for (created_at,) in db.session.query(User.created_at).filter(User.created_at >= window_start):
+        key = ("new_users", _hour_bucket(created_at))
+        counts[key] = counts.get(key, 0) + 1
+    for (last_login_at,) in db.session.query(User.last_login_at).filter(User.last_login_at >= window_start):
+        key = ("last_login", _hour_bucket(last_login_at))
+        counts[key] = counts.get(key, 0) + 1
+    StatBucket.query.delete()
+    db.session.add_all([StatBucket(metric=metric, bucket_start=bucket_start, value=value)
+                        for (metric, bucket_start), value in counts.items()])
+    db.session.commit()
+
+def ensure_admin_stats():
+    # Seeds the counters once, on the primary (startup or the reconcile-stats command). Never done from a
+    # page: under use_read_replica the recount would read a lagging replica and store its totals for good.
+    present = {name for (name,) in db.session.query(AdminStat.stat_name)}
+    if any(name not in present for name in ADMIN_STAT_NAMES):
+        reconcile_admin_stats()
+        return True
+    return False
+
+def read_admin_stats():
+    # Two small reads: the running totals and the hourly buckets for the last month
+    stats = dict(db.session.query(AdminStat.stat_name, AdminStat.value).all())
+    missing = [name for name in ADMIN_STAT_NAMES if name not in stats]
+    if missing:
+        app.logger.warning("Admin counters %s are missing; run 'flask reconcile-stats'", ", ".join(missing))
+        stats.update(dict.fromkeys(missing, 0.0))
+    now = datetime.utcnow()
+    today = datetime.combine(now.date(), datetime.min.time())
+    start_of_week = today - timedelta(days=today.weekday())
+    start_of_month = today.replace(day=1)
+    active_24h_start = _hour_bucket(now - timedelta(hours=24))
+    active_7d_start = _hour_bucket(now - timedelta(days=7))
+    buckets = db.session.query(StatBucket.metric, StatBucket.bucket_start, StatBucket.value)\
+                        .filter(StatBucket.bucket_start >= min(start_of_month, active_7d_start)).all()
+    stats.update(active_users_24h=0, active_users_7d=0, new_users_today=0, new_users_this_week=0, new_users_this_month=0)
+    for metric, bucket_start, value in buckets:
+        if metric == "last_login":
+            if bucket_start >= active_24h_start:
+                stats["active_users_24h"] += value
+            if bucket_start >= active_7d_start:
+                stats["active_users_7d"] += value
+        elif metric == "new_users":
+            if bucket_start >= today:
+                stats["new_users_today"] += value
+            if bucket_start >= start_of_week:
+                stats["new_users_this_week"] += value
+            if bucket_start >= start_of_month:
+                stats["new_users_this_month"] += value
+    return stats
+
+@app.cli.command("reconcile-stats")
+def reconcile_stats_command():
+    """Recompute admin dashboard counters from scratch (run periodically, e.g. from cron)."""
+    reconcile_admin_stats()
+    print("Admin statistics reconciled.")
+
+# --- Referral Tree ---
+def extend_referral_tree(new_user_id, referrer_id):
+    # Runs inside the registration transaction: links the new user under the referrer and every
+    # ancestor of the referrer, and bumps their downline counters.
+    closure = ReferralClosure.__table__
+    db.session.execute(closure.insert().from_select(
+        ["ancestor_id", "descendant_id", "depth"],
+        db.select(closure.c.ancestor_id, db.literal(new_user_id), closure.c.depth + 1)
+          .where(closure.c.descendant_id == referrer_id)))
+    db.session.execute(closure.insert().values(ancestor_id=referrer_id, descendant_id=new_user_id, depth=1))
+    ancestors = db.select(closure.c.ancestor_id).where(closure.c.descendant_id == referrer_id)
+    User.query.filter((User.id == referrer_id) | User.id.in_(ancestors))\
+              .update({User.downline_count: User.downline_count + 1}, synchronize_session=False)
+
+def referral_team(user_id, max_depth, limit):
+    # Descendants up to max_depth, nearest levels first, plus a per-level head count
+    members = db.session.query(User.username, User.display_name, User.created_at, User.referral_count,
+                               ReferralClosure.depth)\
+                        .join(ReferralClosure, ReferralClosure.descendant_id == User.id)\
+                        .filter(ReferralClosure.ancestor_id == user_id, ReferralClosure.depth <= max_depth)\
+                        .order_by(ReferralClosure.depth.asc(), User.id.asc()).limit(limit).all()
+    levels = db.session.query(ReferralClosure.depth, func.count())\
+                       .filter(ReferralClosure.ancestor_id == user_id, ReferralClosure.depth <= max_depth)\
+                       .group_by(ReferralClosure.depth).order_by(ReferralClosure.depth).all()
+    return {
+        "levels": [{"depth": depth, "members": count} for depth, count in levels],
+        "members": [{"name": m.display_name or m.username, "depth": m.depth, "referral_count": m.referral_count,
+                     "joined_at": m.created_at.isoformat() if m.created_at else None} for m in members],
+    }
+
+def rebuild_referral_tree():
+    # Recomputes the closure table and both counters from User.referred_by_user_id with a recursive CTE
+    users = User.__table__
+    tree = db.select(users.c.referred_by_user_id.label("ancestor_id"), users.c.id.label("descendant_id"),
+                     db.literal(1).label("depth"))\
+             .where(users.c.referred_by_user_id.isnot(None)).cte("tree", recursive=True)
+    tree = tree.union_all(db.select(tree.c.ancestor_id, users.c.id, tree.c.depth + 1)
+                            .where(users.c.referred_by_user_id == tree.c.descendant_id))
+    closure = ReferralClosure.__table__
+    db.session.execute(closure.delete())
+    db.session.execute(closure.insert().from_select(["ancestor_id", "descendant_id", "depth"],
+                                                    db.select(tree.c.ancestor_id, tree.c.descendant_id, tree.c.depth)))
+    direct = db.select(func.count()).where(closure.c.ancestor_id == users.c.id, closure.c.depth == 1).scalar_subquery()
+    downline = db.select(func.count()).where(closure.c.ancestor_id == users.c.id).scalar_subquery()
+    db.session.execute(users.update().values(referral_count=direct, downline_count=downline))
+    db.session.commit()
+
+@app.cli.command("rebuild-referrals")
+def rebuild_referrals_command():
+    """Rebuild the referral closure table and per-user referral counters."""
+    rebuild_referral_tree()
+    reconcile_admin_stats()
+    print("Referral tree rebuilt.")
+
+# --- Price History Buckets ---
+PRICE_BUCKET_FORMATS = {"minute": "%Y-%m-%d %H:%M:00", "hour": "%Y-%m-%d %H:00:00", "day": "%Y-%m-%d 00:00:00"}
+
+def _truncate_to_interval(ts, interval):
+    if interval == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if interval == "hour":
+        return _hour_bucket(ts)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _price_bucket_expr(column, interval):
+    if db.engine.dialect.name == "postgresql":
+        return func.date_trunc(interval, column)
+    return func.strftime(PRICE_BUCKET_FORMATS[interval], column)
+
+def raw_price_ohlc(interval, start=None, end=None):
+    # OHLC over raw rows computed in SQL; open/close are the first/last row (by id) in each bucket
+    bucket = _price_bucket_expr(TokenPriceHistory.timestamp, interval).label("bucket")
+    grouped = db.session.query(bucket,
+                               func.min(TokenPriceHistory.id).label("first_id"),
+                               func.max(TokenPriceHistory.id).label("last_id"),
+                               func.max(TokenPriceHistory.price_usd).label("high"),
+                               func.min(TokenPriceHistory.price_usd).label("low"),
+                               func.count(TokenPriceHistory.id).label("samples"))
+    if start is not None:
+        grouped = grouped.filter(TokenPriceHistory.timestamp >= start)
+    if end is not None:
+        grouped = grouped.filter(TokenPriceHistory.timestamp < end)
+    grouped = grouped.group_by(bucket).subquery()
+    first_row = db.aliased(TokenPriceHistory)
+    last_row = db.aliased(TokenPriceHistory)
+    rows = db.session.query(grouped.c.bucket, first_row.price_usd, grouped.c.high, grouped.c.low,
+                            last_row.price_usd, grouped.c.samples)\
+                     .join(first_row, first_row.id == grouped.c.first_id)\
+                     .join(last_row, last_row.id == grouped.c.last_id)\
+                     .order_by(grouped.c.bucket).all()
+    return [{"bucket_start": b if isinstance(b, datetime) else datetime.fromisoformat(b),
+             "open": o, "high": h, "low": l, "close": c, "samples": n} for b, o, h, l, c, n in rows]
+
+def _merge_price_bucket(buckets, bucket):
+    # Appends to an ordered bucket list, folding into the last bucket when the start matches
+    if buckets and buckets[-1]["bucket_start"] == bucket["bucket_start"]:
+        last = buckets[-1]
+        last["high"] = max(last["high"], bucket["high"])
+        last["low"] = min(last["low"], bucket["low"])
+        last["close"] = bucket["close"]
+        last["samples"] += bucket["samples"]
+    else:
+        buckets.append(dict(bucket))
+
+def price_ohlc(interval, start):
+    # Compacted hours come from TokenPriceRollup (hour resolution at best), newer data from the raw table
+    buckets = []
+    rollups = TokenPriceRollup.query.filter(TokenPriceRollup.bucket_start >= _hour_bucket(start))\
+                                    .order_by(TokenPriceRollup.bucket_start.asc()).all()
+    rollup_interval = "hour" if interval == "minute" else interval
+    for r in rollups:
+        _merge_price_bucket(buckets, {"bucket_start": _truncate_to_interval(r.bucket_start, rollup_interval),
+                                      "open": r.open_usd, "high": r.high_usd, "low": r.low_usd,
+                                      "close": r.close_usd, "samples": r.samples})
+    for bucket in raw_price_ohlc(interval, start=start):
+        _merge_price_bucket(buckets, bucket)
+    return buckets
+
+def price_history_etag(*parts):
+    # Changes whenever a price row is written or compacted, so polling clients can revalidate cheaply
+    latest_raw = db.session.query(func.max(TokenPriceHistory.id)).scalar()
+    latest_rollup = db.session.query(func.max(TokenPriceRollup.id)).scalar()
+    key = ":".join(str(p) for p in (latest_raw, latest_rollup) + parts)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def compact_price_history():
+    # Folds raw rows older than the retention window into hourly rollups and deletes them
+    cutoff = _hour_bucket(datetime.utcnow() - timedelta(days=app.config["PRICE_HISTORY_RAW_RETENTION_DAYS"]))
+    buckets = raw_price_ohlc("hour", end=cutoff)
+    if not buckets:
+        return 0
+    existing = {r.bucket_start: r for r in TokenPriceRollup.query.filter(
+        TokenPriceRollup.bucket_start.in_([b["bucket_start"] for b in buckets]))}
+    for b in buckets:
+        rollup = existing.get(b["bucket_start"])
+        if rollup:
+            # Late rows for an hour that was already compacted
+            rollup.high_usd = max(rollup.high_usd, b["high"])
+            rollup.low_usd = min(rollup.low_usd, b["low"])
+            rollup.close_usd = b["close"]
+            rollup.samples += b["samples"]
+        else:
+            db.session.add(TokenPriceRollup(bucket_start=b["bucket_start"], open_usd=b["open"], high_usd=b["high"],
+                                            low_usd=b["low"], close_usd=b["close"], samples=b["samples"]))
+    deleted = TokenPriceHistory.query.filter(TokenPriceHistory.timestamp < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+@app.cli.command("compact-price-history")
+def compact_price_history_command():
+    """Roll old price history rows up into hourly aggregates (run periodically, e.g. from cron)."""
+    deleted = compact_price_history()
+    print(f"Compacted {deleted} price history rows.")
+
+# --- Admin User Search Index ---
+# SQLite: an external-content FTS5 table with the trigram tokenizer (substring matches, case-insensitive),
+# kept in sync with "user" by triggers. PostgreSQL: pg_trgm GIN indexes, which ILIKE '%q%' can use directly.
+SQLITE_USER_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+           username, email, content='user', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON "user" BEGIN
+           INSERT INTO user_search(rowid, username, email) VALUES (new.id, new.username, new.email);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON "user" BEGIN
+           INSERT INTO user_search(user_search, rowid, username, email) VALUES ('delete', old.id, old.username, old.email);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF username, email ON "user" BEGIN
+           INSERT INTO user_search(user_search, rowid, username, email) VALUES ('delete', old.id, old.username, old.email);
+           INSERT INTO user_search(rowid, username, email) VALUES (new.id, new.username, new.email);
+       END""",
+)
+POSTGRES_USER_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    'CREATE INDEX IF NOT EXISTS ix_user_username_trgm ON "user" USING gin (username gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_user_email_trgm ON "user" USING gin (email gin_trgm_ops)',
+)
+TRIGRAM_MIN_QUERY_LENGTH = 3 # Shorter terms cannot be answered from a trigram index
+
+_user_search_state = {"fts": None}
+
+def ensure_user_search_index(rebuild=False):
+    # The trigram tokenizer needs SQLite 3.34+ and pg_trgm may not be installable; without the index
+    # admin search falls back to ILIKE instead of stopping the app from starting
+    dialect = db.engine.dialect.name
+    try:
+        if dialect == "sqlite":
+            existed = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_search'")).scalar()
+            for statement in SQLITE_USER_SEARCH_DDL:
+                db.session.execute(text(statement))
+            if rebuild or not existed:
+                db.session.execute(text("INSERT INTO user_search(user_search) VALUES ('rebuild')"))
+        elif dialect == "postgresql":
+            for statement in POSTGRES_USER_SEARCH_DDL:
+                db.session.execute(text(statement))
+        db.session.commit()
+    except (OperationalError, ProgrammingError) as e:
+        db.session.rollback()
+        app.logger.warning("User search index unavailable, admin search will use ILIKE: %s", e.orig)
+        _user_search_state["fts"] = False
+        return False
+    _user_search_state["fts"] = None
+    return True
+
+def _sqlite_fts_available():
+    if _user_search_state["fts"] is None:
+        _user_search_state["fts"] = db.engine.dialect.name == "sqlite" and bool(db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_search'")).scalar())
+    return _user_search_state["fts"]
+
+def filter_users_by_search(query, search_query):
+    if len(search_query) >= TRIGRAM_MIN_QUERY_LENGTH and _sqlite_fts_available():
+        # A quoted FTS5 string is matched as a substring by the trigram tokenizer
+        match = '"' + search_query.replace('"', '""') + '"'
+        matching_ids = text("SELECT rowid FROM user_search WHERE user_search MATCH :match")\
+            .bindparams(match=match).columns(rowid=db.Integer)
+        return query.filter(User.id.in_(matching_ids))
+    search_term = f"%{search_query}%"
+    return query.filter(User.username.ilike(search_term) | User.email.ilike(search_term))
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Create the admin user search index if needed and rebuild it from the user table."""
+    if ensure_user_search_index(rebuild=True):
+        print("User search index rebuilt.")
+    else:
+        print("User search index is not supported by this database; admin search uses ILIKE.")
+
+# --- Withdrawal Batch Operations ---
+WITHDRAWAL_EXPORT_FIELDS = ("id", "username", "user_id", "tokens_to_withdraw", "global_price_at_withdrawal",
+                            "personal_bonus_at_withdrawal", "total_usd_value_before_commission",
+                            "commission_percentage", "commission_amount_usd", "amount_to_user_usd",
+                            "payment_method", "payment_details", "status", "requested_at", "processed_at",
+                            "admin_notes")
+
+def create_withdrawal(user_id, tokens_to_withdraw, payment_method, payment_details):
+    # Prices and debits inside the caller's transaction. The user row is locked (PostgreSQL) and the
+    # debit is checked after it is appended (SQLite holds the write lock by then), so concurrent
+    # requests cannot overdraw. On error the caller must roll back. Returns (withdrawal, error_message).
+    user = db.session.query(User.id, User.personal_rate_bonus).filter_by(id=user_id).with_for_update().first()
+    if not user:
+        return None, "User not found."
+    amount_micro = to_micro(tokens_to_withdraw)
+
+    current_global_price = get_global_setting("current_global_token_price_usd")
+    effective_rate = current_global_price + user.personal_rate_bonus
+    total_usd_value = tokens_to_withdraw * effective_rate
+    commission = total_usd_value * 0.40
+    amount_to_user = total_usd_value * 0.60
+
+    withdrawal = WithdrawalRequest(
+        user_id=user_id,
+        tokens_to_withdraw=tokens_to_withdraw,
+        global_price_at_withdrawal=current_global_price,
+        personal_bonus_at_withdrawal=user.personal_rate_bonus,
+        total_usd_value_before_commission=total_usd_value,
+        commission_amount_usd=commission,
+        amount_to_user_usd=amount_to_user,
+        payment_method=payment_method,
+        payment_details=payment_details,
+        tokens_to_withdraw_micro=amount_micro
+    )
+    db.session.add(withdrawal)
+    db.session.flush()
+    append_ledger_entry(user_id, "withdrawal_debit", -amount_micro, withdrawal.id)
+    balance_tokens, _ = ledger_balances([user_id])[user_id]
+    if to_micro(balance_tokens) < 0:
+        return None, "Invalid withdrawal amount or insufficient balance."
+    bump_admin_stats(tokens_in_circulation=-tokens_to_withdraw, pending_withdrawals_count=1,
+                     total_usd_pending_withdrawal=amount_to_user)
+    return withdrawal, None
+
+def apply_withdrawal_action(request_ids, action, admin_notes=""):
+    # Marks the still-pending requests among request_ids as processed/rejected in one transaction
+    actioned, refunded_user_ids = _apply_withdrawal_action(request_ids, action, admin_notes)
+    db.session.commit()
+    publish_balances(refunded_user_ids)
+    return actioned
+
+def _apply_withdrawal_action(request_ids, action, admin_notes):
+    # The guarded UPDATE ... RETURNING decides which requests move out of pending, so concurrent actions
+    # on the same request cannot both refund it; refunds are then one bulk ledger insert per chunk. The caller commits.
+    withdrawals = WithdrawalRequest.__table__
+    now = datetime.utcnow()
+    chunk_size = app.config["WITHDRAWAL_BULK_CHUNK_SIZE"]
+    actioned = 0
+    refunded_user_ids = set()
+    columns = (withdrawals.c.id, withdrawals.c.user_id, withdrawals.c.tokens_to_withdraw,
+               withdrawals.c.tokens_to_withdraw_micro, withdrawals.c.amount_to_user_usd,
+               withdrawals.c.commission_amount_usd)
+    for i in range(0, len(request_ids), chunk_size):
+        chunk = request_ids[i:i + chunk_size]
+        pending = withdrawals.c.id.in_(chunk) & (withdrawals.c.status == "pending")
+        guarded = withdrawals.update().where(pending).values(status=action, processed_at=now, admin_notes=admin_notes)
+        if db.engine.dialect.update_returning:
+            rows = db.session.execute(guarded.returning(*columns)).all()
+        else:
+            # No UPDATE ... RETURNING (SQLite before 3.35): lock the pending rows, then run the same guarded UPDATE
+            rows = db.session.execute(db.select(*columns).where(pending).with_for_update()).all()
+            if rows:
+                db.session.execute(guarded.where(withdrawals.c.id.in_([r.id for r in rows])))
+        if not rows:
+            continue
+        amount = sum(r.amount_to_user_usd for r in rows)
+        if action == "processed":
+            bump_admin_stats(pending_withdrawals_count=-len(rows), total_usd_pending_withdrawal=-amount,
+                             total_usd_paid_out=amount,
+                             total_admin_commission=sum(r.commission_amount_usd for r in rows))
+        else:
+            refunds = [{"user_id": r.user_id, "kind": "withdrawal_refund",
+                        "amount_micro": r.tokens_to_withdraw_micro or to_micro(r.tokens_to_withdraw),
+                        "reference_id": r.id, "created_at": now} for r in rows if r.user_id is not None]
+            if refunds:
+                db.session.execute(LedgerEntry.__table__.insert(), refunds)
+            refunded_user_ids.update(refund["user_id"] for refund in refunds)
+            bump_admin_stats(pending_withdrawals_count=-len(rows), total_usd_pending_withdrawal=-amount,
+                             tokens_in_circulation=sum(r.tokens_to_withdraw for r in rows if r.user_id is not None))
+        actioned += len(rows)
+    return actioned, refunded_user_ids
+
+def iter_withdrawal_export(query, export_format):
+    # Yields one encoded line at a time; rows are fetched in batches so memory stays flat
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(WITHDRAWAL_EXPORT_FIELDS)
+    for withdrawal, username in query.yield_per(1000):
+        record = {field: getattr(withdrawal, field, None) for field in WITHDRAWAL_EXPORT_FIELDS}
+        record["username"] = username
+        for field in ("requested_at", "processed_at"):
+            if record[field] is not None:
+                record[field] = record[field].isoformat()
+        if export_format == "csv":
+            writer.writerow([record[field] for field in WITHDRAWAL_EXPORT_FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        else:
+            yield json.dumps(record) + "\n"
+
+# --- Job Queue ---
+JOB_HANDLERS = {}
+
+class JobFailed(Exception):
+    """A job that cannot succeed (e.g. insufficient balance); recorded as failed without retrying."""
+
+def job_handler(kind):
+    def register(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return register
+
+def enqueue_job(kind, payload, user_id=None):
+    # Adds the job to the current transaction; the caller commits
+    job = Job(kind=kind, payload=json.dumps(payload), user_id=user_id)
+    db.session.add(job)
+    return job
+
+def claim_jobs(worker_id, batch_size):
+    now = datetime.utcnow()
+    # Jobs whose worker died mid-run go back to the queue
+    Job.query.filter(Job.status == "running",
+                     Job.locked_at < now - timedelta(seconds=app.config["JOB_LOCK_TIMEOUT_SECONDS"]))\
+             .update({Job.status: "queued", Job.locked_by: None}, synchronize_session=False)
+    candidates = db.select(Job.id).where(Job.status == "queued", Job.run_after <= now)\
+                   .order_by(Job.id).limit(batch_size)
+    if db.engine.dialect.name == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+    Job.query.filter(Job.id.in_(candidates.scalar_subquery()))\
+             .update({Job.status: "running", Job.locked_by: worker_id, Job.locked_at: now,
+                      Job.attempts: Job.attempts + 1}, synchronize_session=False)
+    db.session.commit()
+    return Job.query.filter_by(status="running", locked_by=worker_id).order_by(Job.id).all()
+
+def run_jobs(worker_id, batch_size=50):
+    # Runs one claimed batch; each job gets a savepoint and the batch is committed once
+    jobs = claim_jobs(worker_id, batch_size)
+    for job in jobs:
+        handler = JOB_HANDLERS.get(job.kind)
+        try:
+            if handler is None:
+                raise JobFailed(f"No handler for job kind {job.kind}.")
+            with db.session.begin_nested():
+                result = handler(json.loads(job.payload))
+            job.status = "done"
+            job.result = json.dumps(result)
+            job.finished_at = datetime.utcnow()
+        except JobFailed as e:
+            job.status = "failed"
+            job.result = json.dumps({"message": str(e)})
+            job.finished_at = datetime.utcnow()
+        except Exception as e:
+            job.last_error = repr(e)
+            if job.attempts >= app.config["JOB_MAX_ATTEMPTS"]:
+                job.status = "failed"
+                job.finished_at = datetime.utcnow()
+            else:
+                job.status = "queued"
+                job.run_after = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+        job.locked_by = None
+    commit_balance_changes()
+    return len(jobs)
+
+def start_inline_worker(poll_interval=1.0):
+    # Development convenience: drains the queue from a thread of the web process
+    def loop():
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:inline"
+        while True:
+            with app.app_context():
+                processed = run_jobs(worker_id)
+            if not processed:
+                time.sleep(poll_interval)
+    threading.Thread(target=loop, daemon=True).start()
+
+@job_handler("withdrawal_request")
+def handle_withdrawal_request(payload):
+    withdrawal, error = create_withdrawal(payload["user_id"], payload["tokens_to_withdraw"],
+                                          payload["payment_method"], payload["payment_details"])
+    if error:
+        raise JobFailed(error)
+    db.session.flush()
+    mark_balances_changed([payload["user_id"]])
+    new_balance, _ = ledger_balances([payload["user_id"]])[payload["user_id"]]
+    return {"withdrawal_request_id": withdrawal.id, "new_token_balance": new_balance}
+
+@job_handler("withdrawal_action")
+def handle_withdrawal_action(payload):
+    actioned, refunded_user_ids = _apply_withdrawal_action(payload["request_ids"], payload["action"],
+                                                           payload.get("admin_notes", ""))
+    mark_balances_changed(refunded_user_ids)
+    return {"actioned": actioned}
+
+@app.cli.command("run-worker")
+@click.option("--batch-size", default=50, help="Jobs claimed per batch.")
+@click.option("--poll-interval", default=1.0, help="Seconds to sleep when the queue is empty.")
+@click.option("--once", is_flag=True, help="Process a single batch and exit.")
+def run_worker_command(batch_size, poll_interval, once):
+    """Process queued jobs (withdrawal requests, bulk withdrawal actions)."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Worker {worker_id} started.")
+    try:
+        while True:
+            processed = run_jobs(worker_id, batch_size)
+            if once:
+                break
+            if not processed:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print(f"Worker {worker_id} stopped.")
+
+# --- Request Metrics ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+    def cumulative(self):
+        running = 0
+        for le, n in zip(self.buckets, self.counts):
+            running += n
+            yield le, running
+
+class RequestMetrics:
+    """Per-endpoint latency, SQL and commit counters, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {} # endpoint -> Histogram of seconds
+        self._statements = {} # endpoint -> Histogram of statements per request
+        self._requests = {} # (endpoint, status) -> count
+        self._sql_seconds = {}
+        self._commits = {}
+
+    def record(self, endpoint, status, seconds, statements, sql_seconds, commits):
+        with self._lock:
+            self._latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self._statements.setdefault(endpoint, Histogram(STATEMENT_BUCKETS)).observe(statements)
+            self._requests[(endpoint, status)] = self._requests.get((endpoint, status), 0) + 1
+            self._sql_seconds[endpoint] = self._sql_seconds.get(endpoint, 0.0) + sql_seconds
+            self._commits[endpoint] = self._commits.get(endpoint, 0) + commits
+
+    def render(self, gauges=()):
+        lines = []
+        with self._lock:
+            for name, help_text, histograms in (
+                    ("criptomain_request_duration_seconds", "Request latency by endpoint.", self._latency),
+                    ("criptomain_request_db_statements", "SQL statements issued per request.", self._statements)):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for endpoint, histogram in sorted(histograms.items()):
+                    for le, running in histogram.cumulative():
+                        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{le}"}} {running}')
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.total}')
+                    lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+            lines.append("# HELP criptomain_requests_total Requests by endpoint and status code.")
+            lines.append("# TYPE criptomain_requests_total counter")
+            for (endpoint, status), n in sorted(self._requests.items()):
+                lines.append(f'criptomain_requests_total{{endpoint="{endpoint}",status="{status}"}} {n}')
+            for name, help_text, values in (
+                    ("criptomain_db_seconds_total", "Time spent executing SQL by endpoint.", self._sql_seconds),
+                    ("criptomain_db_commits_total", "Transactions committed by endpoint.", self._commits)):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value}')
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
+
+@db.event.listens_for(Engine, "before_cursor_execute")
+def _metrics_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+@db.event.listens_for(Engine, "after_cursor_execute")
+def _metrics_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("metrics_query_start")
+    if has_request_context() and starts and "_metrics" in g:
+        g._metrics["statements"] += 1
+        g._metrics["sql_seconds"] += time.perf_counter() - starts.pop()
+
+@db.event.listens_for(Engine, "commit")
+def _metrics_commit(conn):
+    if has_request_context() and "_metrics" in g:
+        g._metrics["commits"] += 1
+
+@app.before_request
+def _metrics_start_request():
+    g._metrics = {"start": time.perf_counter(), "statements": 0, "sql_seconds": 0.0, "commits": 0, "status": 500}
+
+@app.after_request
+def _metrics_capture_status(response):
+    if "_metrics" in g:
+        g._metrics["status"] = response.status_code
+    return response
+
+@app.teardown_request
+def _metrics_finish_request(exc):
+    # Runs for failed requests too; streamed responses are timed up to the first byte
+    metrics = g.pop("_metrics", None)
+    if metrics is None:
+        return
+    elapsed = time.perf_counter() - metrics["start"]
+    endpoint = request.endpoint or "unmatched"
+    request_metrics.record(endpoint, metrics["status"], elapsed, metrics["statements"],
+                           metrics["sql_seconds"], metrics["commits"])
+    if elapsed >= app.config["SLOW_REQUEST_SECONDS"]:
+        app.logger.warning("Slow request %s %s (%s): %.1f ms, %d SQL statements in %.1f ms, %d commits",
+                           request.method, request.path, endpoint, elapsed * 1000, metrics["statements"],
+                           metrics["sql_seconds"] * 1000, metrics["commits"])
+
+# --- Password Hashing ---
+class PasswordHasherBusy(Exception):
+    pass
+
+def _timed_hash_call(func, *args):
+    # Runs in a pool process; reports when the work started so queue wait and hash time can be told apart
+    started = time.time()
+    result = func(*args)
+    return result, started, time.time() - started
+
+def normalize_hash_method(method):
+    # Werkzeug fills in default parameters, so "scrypt" is stored as "scrypt:32768:8:1"
+    if method == "scrypt":
+        return "scrypt:32768:8:1"
+    if method == "pbkdf2":
+        return f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}"
+    if method.startswith("pbkdf2:") and method.count(":") == 1:
+        return f"{method}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+def password_needs_rehash(pwhash):
+    return pwhash.split("$", 1)[0] != normalize_hash_method(app.config["PASSWORD_HASH_METHOD"])
+
+class PasswordHasher:
+    """Runs the password KDF on a bounded process pool so logins never block a web worker's CPU."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._hash_seconds = Histogram(LATENCY_BUCKETS)
+        self._wait_seconds = Histogram(LATENCY_BUCKETS)
+        self._rejected = 0
+        self._restarts = 0
+
+    def start(self):
+        # Forked workers only ever run the KDF and leave via os._exit, so inherited locks, connections
+        # and atexit hooks are never touched (spawn would re-import the launching script instead)
+        with self._lock:
+            if self._executor is None and self.app.config["PASSWORD_HASH_WORKERS"] > 0:
+                method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+                self._executor = ProcessPoolExecutor(max_workers=self.app.config["PASSWORD_HASH_WORKERS"],
+                                                     mp_context=multiprocessing.get_context(method))
+            return self._executor
+
+    def warm(self):
+        # Starts every pool process now instead of on the first logins
+        executor = self.start()
+        if executor is not None:
+            workers = self.app.config["PASSWORD_HASH_WORKERS"]
+            list(executor.map(_timed_hash_call, [check_password_hash] * workers, [""] * workers, [""] * workers))
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _discard(self, executor):
+        # A pool process died (OOM killer, SIGKILL) and the executor refuses all further work; the next
+        # start() builds a new pool. Another thread may already have replaced it.
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.app.config["PASSWORD_HASH_METHOD"])
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self._pending >= self.app.config["PASSWORD_HASH_MAX_PENDING"]:
+                self._rejected += 1
+                raise PasswordHasherBusy()
+            self._pending += 1
+        try:
+            submitted = time.time()
+            for attempt in range(2):
+                executor = self.start()
+                if executor is None:
+                    result, started, seconds = _timed_hash_call(func, *args)
+                    break
+                try:
+                    future = executor.submit(_timed_hash_call, func, *args)
+                    result, started, seconds = future.result(timeout=self.app.config["PASSWORD_HASH_TIMEOUT_SECONDS"])
+                    break
+                except FutureTimeoutError:
+                    future.cancel()
+                    raise PasswordHasherBusy()
+                except BrokenProcessPool:
+                    # Retried once on a fresh pool; if that breaks too, answer 503 rather than 500
+                    self._discard(executor)
+                    if attempt:
+                        raise PasswordHasherBusy()
+        finally:
+            with self._lock:
+                self._pending -= 1
+        with self._lock:
+            self._hash_seconds.observe(seconds)
+            self._wait_seconds.observe(max(0.0, started - submitted))
+        return result
+
+    def render_metrics(self):
+        lines = []
+        with self._lock:
+            for name, help_text, histogram in (
+                    ("criptomain_password_hash_seconds", "Time spent in the password KDF.", self._hash_seconds),
+                    ("criptomain_password_hash_wait_seconds", "Time password jobs waited for a pool worker.",
+                     self._wait_seconds)):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for le, running in histogram.cumulative():
+                    lines.append(f'{name}_bucket{{le="{le}"}} {running}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum {histogram.total}")
+                lines.append(f"{name}_count {histogram.count}")
+            for name, kind, help_text, value in (
+                    ("criptomain_password_hash_queue_depth", "gauge", "Password jobs queued or running.", self._pending),
+                    ("criptomain_password_hash_workers", "gauge", "Password hashing pool size.",
+                     self.app.config["PASSWORD_HASH_WORKERS"]),
+                    ("criptomain_password_hash_rejected_total", "counter", "Password jobs refused because the queue was full.",
+                     self._rejected),
+                    ("criptomain_password_hash_pool_restarts_total", "counter",
+                     "Pools rebuilt after a worker process died.", self._restarts)):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+password_hasher = PasswordHasher(app)
+atexit.register(password_hasher.shutdown)
+
+# --- Static Assets ---
+COMPRESSIBLE_ASSET_TYPES = (".css", ".js", ".svg", ".json", ".txt", ".html", ".map")
+
+class AssetPipeline:
+    """Fingerprints files from the static folder so they can be cached forever; the manifest maps
+    logical names ("style.css") to built names ("style.3f2a9c1b0d4e.css")."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self.manifest = None
+        self._built_names = frozenset()
+
+    def build(self):
+        manifest = {}
+        source_root = self.app.static_folder
+        build_root = self.app.config["ASSET_BUILD_FOLDER"]
+        if source_root and os.path.isdir(source_root):
+            os.makedirs(build_root, exist_ok=True)
+            for directory, _, files in os.walk(source_root):
+                for name in files:
+                    source = os.path.join(directory, name)
+                    logical = os.path.relpath(source, source_root).replace(os.sep, "/")
+                    manifest[logical] = self._build_file(source, logical, build_root)
+            self._write_atomic(os.path.join(build_root, "manifest.json"), json.dumps(manifest, indent=2).encode())
+        with self._lock:
+            self._built_names = frozenset(manifest.values())
+            self.manifest = manifest
+        return manifest
+
+    def _build_file(self, source, logical, build_root):
+        with open(source, "rb") as f:
+            content = f.read()
+        stem, ext = os.path.splitext(logical)
+        built = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+        target = os.path.join(build_root, built)
+        if not os.path.exists(target): # Same name means same content, so existing builds are reused
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            self._write_atomic(target, content)
+            if ext.lower() in COMPRESSIBLE_ASSET_TYPES and len(content) >= self.app.config["ASSET_GZIP_MIN_BYTES"]:
+                compressed = gzip.compress(content, compresslevel=9, mtime=0)
+                if len(compressed) < len(content):
+                    self._write_atomic(target + ".gz", compressed)
+        return built
+
+    def _write_atomic(self, path, content):
+        # Several workers may build at once; readers only ever see complete files
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    def ensure_built(self):
+        if self.manifest is None:
+            self.build() # Concurrent first builds write identical files, so no lock is needed around this
+        return self.manifest
+
+    def is_built_name(self, built):
+        return built in self._built_names
+
+    def url_for(self, filename):
+        built = self.ensure_built().get(filename)
+        if built is None:
+            return url_for("static", filename=filename)
+        return url_for("asset", filename=built)
+
+asset_pipeline = AssetPipeline(app)
+app.jinja_env.globals["asset_url"] = asset_pipeline.url_for
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Fingerprint and precompress the static folder (also done on first use)."""
+    manifest = asset_pipeline.build()
+    print(f"Built {len(manifest)} assets into {app.config['ASSET_BUILD_FOLDER']}.")
+
+# --- Application Configuration ---
+_configure_app_lock = threading.RLock()
+
+def configure_app(config=None):
+    # Not a factory: routes, caches and workers are bound to the module-level app, so there is exactly one
+    # application per process and this configures it. The first call applies config and binds the
+    # extensions; without an explicit call that happens on the first app context (so `flask --app app ...`
+    # keeps working). Tests and tools that need a different config run in their own process.
+    with _configure_app_lock:
+        if "sqlalchemy" in app.extensions:
+            if config:
+                raise RuntimeError("configure_app(config) must be called before the application is first used.")
+            return app
+        if isinstance(config, dict):
+            app.config.from_mapping(config)
+        elif config is not None:
+            app.config.from_object(config)
+        if app.config.get("TEMPLATE_FOLDER"):
+            app.template_folder = app.config["TEMPLATE_FOLDER"]
+        if app.config.get("STATIC_FOLDER"):
+            app.static_folder = app.config["STATIC_FOLDER"]
+        if make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() != "sqlite":
+            app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {
+                "pool_size": app.config["DB_POOL_SIZE"],
+                "max_overflow": app.config["DB_MAX_OVERFLOW"],
+                "pool_timeout": app.config["DB_POOL_TIMEOUT"],
+                "pool_recycle": app.config["DB_POOL_RECYCLE"],
+                "pool_pre_ping": True,
+            })
+        if app.config["READ_DATABASE_URL"]:
+            app.config.setdefault("SQLALCHEMY_BINDS", {"read": app.config["READ_DATABASE_URL"]})
+        if app.config["TRUSTED_PROXY_COUNT"]:
+            proxies = app.config["TRUSTED_PROXY_COUNT"]
+            app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+        db.init_app(app)
+    return app
+
+@appcontext_pushed.connect_via(app)
+def _configure_app_on_first_use(sender, **extra):
+    if "sqlalchemy" not in sender.extensions:
+        configure_app()
 
 # --- Initialization Function ---
 def initialize_global_settings():
@@ -162,6 +2183,184 @@ def initialize_global_settings():
         else:
             print("Global settings already exist.")
 
+# Columns added to tables that already exist in deployed databases; create_all() never adds columns
+ADDED_COLUMNS = (
+    ("user", "referral_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("user", "downline_count", "INTEGER NOT NULL DEFAULT 0"),
+    # Older requests keep NULL; their debits and refunds fall back to to_micro(tokens_to_withdraw)
+    ("withdrawal_request", "tokens_to_withdraw_micro", "BIGINT"),
+)
+
+def add_missing_columns():
+    # Idempotent ALTER TABLE ... ADD COLUMN for ADDED_COLUMNS; returns the "table.column" names it added
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    added = []
+    for table, column, ddl in ADDED_COLUMNS:
+        if not inspector.has_table(table):
+            continue # create_all() creates it with every column
+        if column in {c["name"] for c in inspector.get_columns(table)}:
+            continue
+        db.session.execute(text(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {ddl}"))
+        added.append(f"{table}.{column}")
+    db.session.commit()
+    return added
+
+def migrate_schema():
+    # Brings a database created by any earlier version up to the models, in dependency order: columns
+    # on existing tables, then indexes on them (some cover the new columns), then new tables with their
+    # indexes, then backfills. Returns (added "table.column" names, created index names).
+    added = add_missing_columns()
+    created = ensure_indexes()
+    db.create_all()
+    if "user.referral_count" in added or "user.downline_count" in added:
+        rebuild_referral_tree() # Backfill the counters (and the closure table) from referred_by_user_id
+    return added, created
+
+def ensure_indexes():
+    # Adds indexes declared on the models since an existing table was created (SQLAlchemy before 2.1
+    # only creates indexes together with a new table). Idempotent, returns the names of the indexes it created.
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+@app.cli.command("migrate-db")
+def migrate_db_command():
+    """Add missing columns, indexes and tables to an existing database (safe to run repeatedly)."""
+    added, created = migrate_schema()
+    print(f"Added {len(added)} columns, created {len(created)} indexes.")
+    for name in added + created:
+        print(f"  {name}")
+
+# --- Keyset Pagination ---
+class KeysetPage:
+    """One page of a keyset-paginated query; cursors are opaque tokens for the neighbouring pages."""
+
+    def __init__(self, items, per_page, next_cursor, prev_cursor, total, total_is_estimate):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+
+def _cursor_serializer():
+    return URLSafeSerializer(app.config["SECRET_KEY"], salt="keyset-cursor")
+
+def encode_cursor(direction, values):
+    return _cursor_serializer().dumps([direction] + [v.isoformat() if isinstance(v, datetime) else v for v in values])
+
+def decode_cursor(cursor, keys):
+    # Returns (direction, values); tampered or malformed cursors fall back to the first page
+    try:
+        direction, *values = _cursor_serializer().loads(cursor)
+        if direction not in ("next", "prev") or len(values) != len(keys):
+            return None, None
+        return direction, [datetime.fromisoformat(v) if isinstance(column.type, db.DateTime) and v is not None else v
+                           for (column, _), v in zip(keys, values)]
+    except (BadSignature, ValueError, TypeError):
+        return None, None
+
+def _keyset_after(keys, values, backwards):
+    # Rows after the cursor in (possibly reversed) key order, written so the index seeks to the cursor
+    # instead of walking every earlier row
+    columns = [column for column, _ in keys]
+    if len({descending for _, descending in keys}) == 1:
+        # Same direction for every key: a row-value comparison, (k1, k2) < (v1, v2)
+        row, cursor_row = db.tuple_(*columns), db.tuple_(*[db.literal(v, c.type) for c, v in zip(columns, values)])
+        return row < cursor_row if keys[0][1] != backwards else row > cursor_row
+    # Mixed ASC/DESC: (k1 > v1) OR (k1 = v1 AND k2 > v2) ..., with each comparison flipped for descending
+    # keys, under an outer bound on the leading key that the index can range-scan
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        later = column < values[i] if descending != backwards else column > values[i]
+        clauses.append(db.and_(*[keys[j][0] == values[j] for j in range(i)], later))
+    first, descending = keys[0]
+    bound = first <= values[0] if descending != backwards else first >= values[0]
+    return db.and_(bound, db.or_(*clauses))
+
+def keyset_paginate(query, keys, cursor=None, per_page=None, total=None, total_is_estimate=False):
+    # keys: [(column, descending)], ending with a unique column. Each page is an index range scan
+    # of per_page + 1 rows, however deep it is.
+    per_page = per_page or app.config["ADMIN_PAGE_SIZE"]
+    direction, values = decode_cursor(cursor, keys) if cursor else (None, None)
+    backwards = direction == "prev"
+    if direction:
+        query = query.filter(_keyset_after(keys, values, backwards))
+    order = [column.desc() if descending != backwards else column.asc() for column, descending in keys]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def cursor_for(direction, row):
+        return encode_cursor(direction, [getattr(row, column.key) for column, _ in keys])
+
+    has_next = more if not backwards else True
+    has_prev = more if backwards else direction is not None
+    return KeysetPage(rows, per_page,
+                      cursor_for("next", rows[-1]) if rows and has_next else None,
+                      cursor_for("prev", rows[0]) if rows and has_prev else None,
+                      total, total_is_estimate)
+
+class CountCache:
+    """Caches COUNT(*) results per filter so paging through a list does not recount it every request."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._counts = {} # key -> (count, counted_at)
+
+    def count(self, key, query):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._counts.get(key)
+        if cached and now - cached[1] < self.app.config["ADMIN_COUNT_CACHE_SECONDS"]:
+            return cached[0]
+        value = query.order_by(None).count()
+        with self._lock:
+            if len(self._counts) > 1000:
+                self._counts.clear()
+            self._counts[key] = (value, now)
+        return value
+
+count_cache = CountCache(app)
+
+# --- Current User ---
+# Column sets for the hot endpoints, so polling never pulls hashes or unrelated profile text
+USER_SETTINGS_COLUMNS = (User.username, User.display_name, User.phone_number, User.payment_address,
+                         User.music_enabled, User.selected_music_track, User.selected_theme,
+                         User.selected_click_animation, User.sound_effects_enabled)
+GAME_STATE_COLUMNS = USER_SETTINGS_COLUMNS + (User.referral_code, User.personal_rate_bonus)
+
+def current_user(*columns):
+    # Loads the logged-in user at most once per request. With columns, only those are selected;
+    # a later call asking for more reloads once with the union rather than lazy-loading per attribute.
+    cached = g.get("_current_user")
+    wanted = {c.key for c in columns} if columns else None
+    if cached is not None:
+        user, loaded = cached
+        if loaded is None or (wanted is not None and wanted <= loaded):
+            return user
+        wanted = None if wanted is None else wanted | loaded
+    query = User.query.filter_by(id=session["user_id"]).populate_existing()
+    if wanted is not None:
+        query = query.options(db.load_only(*[getattr(User, key) for key in wanted]))
+    user = query.first()
+    g._current_user = (user, wanted)
+    return user
+
 # --- Decorators ---
 def login_required(f):
     @wraps(f)
@@ -172,13 +2371,21 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def use_read_replica(f):
+    # Place directly under @app.route so every read in the request, including auth checks, uses the replica
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g._use_read_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "user_id" not in session:
             flash("Please log in to access this page.", "warning")
             return redirect(url_for("login", next=request.url))
-        user = User.query.get(session["user_id"])
+        user = current_user(User.is_admin)
         if not user or not user.is_admin:
             flash("You do not have permission to access this page.", "danger")
             return redirect(url_for("index"))
@@ -186,6 +2393,25 @@ def admin_required(f):
     return decorated_function
 
 # --- Routes ---
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    # Only fingerprinted names are served, so responses can be cached as immutable
+    asset_pipeline.ensure_built()
+    if not asset_pipeline.is_built_name(filename):
+        abort(404)
+    path = os.path.join(app.config["ASSET_BUILD_FOLDER"], filename)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    if "gzip" in request.headers.get("Accept-Encoding", "") and os.path.isfile(path + ".gz"):
+        path, encoding = path + ".gz", "gzip"
+    response = send_file(path, mimetype=mimetype, max_age=app.config["ASSET_MAX_AGE_SECONDS"], conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -198,13 +2424,13 @@ def game():
 @app.route("/profile", methods=["GET"])
 @login_required
 def profile_get(): # Renamed to avoid conflict, GET for profile page
-    user = User.query.get(session["user_id"])
+    user = current_user()
     return render_template("profile.html", user=user)
 
 @app.route("/settings", methods=["GET"])
 @login_required
 def settings_page(): # Route to display the settings page
-    user = User.query.get(session["user_id"])
+    user = current_user(*USER_SETTINGS_COLUMNS)
     # Music tracks and themes would ideally come from a config or another DB table
     # For now, let's assume some defaults for the template to render
     available_music_tracks = [{"id": "track1.mp3", "name": "Chill Vibe"}, {"id": "track2.mp3", "name": "Upbeat Energy"}]
@@ -218,7 +2444,7 @@ def settings_page(): # Route to display the settings page
 @app.route("/api/user_settings", methods=["GET", "POST"])
 @login_required
 def user_settings_api():
-    user = User.query.get(session["user_id"])
+    user = current_user(*USER_SETTINGS_COLUMNS)
     if request.method == "GET":
         return jsonify({
             "success": True,
@@ -251,6 +2477,7 @@ def user_settings_api():
             user.sound_effects_enabled = bool(data["sound_effects_enabled"])
         
         db.session.commit()
+        leaderboard.rename(user.id, user.display_name or user.username)
         return jsonify({"success": True, "message": "Settings updated successfully."})
 
 @app.route("/register", methods=["GET", "POST"])
@@ -276,36 +2503,56 @@ def register():
             return redirect(url_for("register"))
 
         new_user = User(username=username, email=email, display_name=username) # Set initial display_name
-        new_user.set_password(password)
+        try:
+            new_user.set_password(password)
+        except PasswordHasherBusy:
+            flash("Too many sign-ups right now. Please try again in a moment.", "warning")
+            return render_template("register.html"), 503
         new_user.generate_referral_code()
         db.session.add(new_user)
         db.session.flush() 
 
+        # Everything below is committed together: user, referral bonus, counter, price and history
+        referrer = None
         if referral_code_input:
             referrer = User.query.filter_by(referral_code=referral_code_input).first()
             if referrer and referrer.id != new_user.id:
                 new_user.referred_by_user_id = referrer.id
-                referrer.personal_rate_bonus += 0.01
+                if not referrer.referral_count:
+                    bump_admin_stats(referrers_count=1)
+                referrer.personal_rate_bonus = User.personal_rate_bonus + 0.01
+                referrer.referral_count = User.referral_count + 1
                 referral_record = Referral(referrer_user_id=referrer.id, referred_user_id=new_user.id)
                 db.session.add(referral_record)
-                db.session.add(referrer)
-                flash(f"Successfully registered! You were referred by {referrer.username}. Their rate bonus increased!", "success")
+                extend_referral_tree(new_user.id, referrer.id)
+                bump_admin_stats(total_referrals=1)
             else:
-                flash("Invalid or self-referral code. Registered without referral bonus.", "warning")
-        else:
-            flash("Successfully registered!", "success")
+                referrer = None
 
-        total_users = get_global_setting("total_users", 0, int) + 1
-        set_global_setting("total_users", total_users)
-        initial_price = get_global_setting("initial_token_price_usd")
-        increment = get_global_setting("price_increment_per_user_usd")
-        current_total_users_for_price = total_users 
-        new_global_price = initial_price + (current_total_users_for_price * increment) 
-        set_global_setting("current_global_token_price_usd", new_global_price)
+        _, new_global_price = increment_total_users_and_reprice()
         price_log = TokenPriceHistory(price_usd=new_global_price, reason=f"New user: {username} (ID: {new_user.id})")
         db.session.add(price_log)
-        
-        db.session.commit()
+        bump_stat_bucket("new_users", datetime.utcnow())
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent sign-up took the same username or email
+            db.session.rollback()
+            flash("Username or email already registered.", "danger")
+            return redirect(url_for("register"))
+        settings_cache.invalidate()
+        leaderboard.add(new_user.id, new_user.display_name or new_user.username)
+        event_hub.publish_price(new_global_price)
+        event_recorder.record("register", username=username, email=email,
+                              referrer=referrer.username if referrer else None)
+
+        if referrer:
+            flash(f"Successfully registered! You were referred by {referrer.username}. Their rate bonus increased!", "success")
+        elif referral_code_input:
+            flash("Invalid or self-referral code. Registered without referral bonus.", "warning")
+        else:
+            flash("Successfully registered!", "success")
         session["user_id"] = new_user.id
         session["username"] = new_user.username
         session["is_admin"] = new_user.is_admin
@@ -318,12 +2565,19 @@ def login():
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
-        user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        user = User.query.options(db.undefer(User.password_hash)).filter_by(username=username).first()
+        try:
+            valid = user is not None and user.check_password(password)
+        except PasswordHasherBusy:
+            flash("Too many sign-ins right now. Please try again in a moment.", "warning")
+            return render_template("login.html"), 503
+        if valid:
             session["user_id"] = user.id
             session["username"] = user.username
             session["is_admin"] = user.is_admin
+            previous_login_at = user.last_login_at
             user.last_login_at = datetime.utcnow()
+            record_login_stats(previous_login_at, user.last_login_at)
             db.session.commit()
             flash("Logged in successfully!", "success")
             next_url = request.args.get("next")
@@ -348,13 +2602,14 @@ def logout():
 @app.route("/api/game_state", methods=["GET"])
 @login_required
 def get_game_state():
-    user = User.query.get(session["user_id"])
+    user = current_user(*GAME_STATE_COLUMNS)
     current_global_price = get_global_setting("current_global_token_price_usd")
     effective_rate = current_global_price + user.personal_rate_bonus
+    tokens, taps = project_tap_state(*ledger_balances([user.id])[user.id], tap_accumulator.pending_for(user.id))
     return jsonify({
         "username": user.username,
-        "cripto_main_tokens": user.cripto_main_tokens,
-        "taps_for_next_token": user.taps_for_next_token,
+        "cripto_main_tokens": tokens,
+        "taps_for_next_token": taps,
         "referral_code": user.referral_code,
         "current_global_token_price_usd": current_global_price,
         "personal_rate_bonus": user.personal_rate_bonus,
@@ -375,26 +2630,83 @@ def get_game_state():
 @app.route("/api/record_tap", methods=["POST"])
 @login_required
 def record_tap_route():
-    user = User.query.get(session["user_id"])
-    user.taps_for_next_token += 1
-    tokens_earned_this_tap = 0
-    if user.taps_for_next_token >= 100:
-        tokens_earned_this_tap = user.taps_for_next_token // 100
-        user.cripto_main_tokens += tokens_earned_this_tap
-        user.taps_for_next_token %= 100
-    db.session.commit()
+    limited = tap_rate_limit_response(1)
+    if limited:
+        return limited
+    return _record_taps(session["user_id"], 1)
+
+@app.route("/api/record_taps", methods=["POST"])
+@login_required
+def record_taps_route():
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(data.get("count", 0))
+        seq = int(data["seq"]) if data.get("seq") is not None else None
+    except (ValueError, TypeError):
+        return jsonify({"success": False, "message": "Invalid tap count or sequence number."}), 400
+    max_batch = max_tap_batch()
+    if count <= 0 or count > max_batch:
+        return jsonify({"success": False, "message": f"Tap count must be between 1 and {max_batch}.",
+                        "max_batch": max_batch}), 400
+    limited = tap_rate_limit_response(count)
+    if limited:
+        return limited
+    return _record_taps(session["user_id"], count, seq)
+
+def _record_taps(user_id, count, seq=None):
+    # No database round trip once the user's balance is cached in the accumulator
+    before_tokens, _ = tap_accumulator.balance(user_id)
+    accepted = tap_accumulator.add(user_id, count, seq)
+    tokens, taps = tap_accumulator.balance(user_id)
+    if accepted:
+        # Rejected retries are not recorded, so a replay does not apply them again
+        event_recorder.record("tap", username=session.get("username"), count=count)
+        event_hub.publish(user_id, "balance", {"cripto_main_tokens": tokens, "taps_for_next_token": taps})
     return jsonify({
         "success": True,
-        "cripto_main_tokens": user.cripto_main_tokens,
-        "taps_for_next_token": user.taps_for_next_token,
-        "tokens_earned_this_tap": tokens_earned_this_tap
+        "accepted": accepted,
+        "cripto_main_tokens": tokens,
+        "taps_for_next_token": taps,
+        "tokens_earned_this_tap": tokens - before_tokens
     })
 
+@app.route("/api/stream", methods=["GET"])
+@login_required
+def stream_route():
+    user = current_user(User.personal_rate_bonus)
+    tokens, taps = project_tap_state(*ledger_balances([user.id])[user.id], tap_accumulator.pending_for(user.id))
+    current_global_price = get_global_setting("current_global_token_price_usd")
+    subscriber = event_hub.subscribe(user.id)
+    if subscriber is None:
+        return jsonify({"success": False, "message": "Too many open streams."}), 429
+    keepalive = app.config["SSE_KEEPALIVE_SECONDS"]
+
+    def generate():
+        yield sse_frame("balance", {"cripto_main_tokens": tokens, "taps_for_next_token": taps})
+        yield sse_frame("price", {"current_global_token_price_usd": current_global_price,
+                                  "personal_rate_bonus": user.personal_rate_bonus})
+        while True:
+            events = subscriber.drain(keepalive)
+            if events is None:
+                return
+            if not events:
+                yield ": keepalive\n\n"
+            for event, data in events.items():
+                yield sse_frame(event, data)
+
+    response = app.response_class(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # Stop reverse proxies from buffering the stream
+    response.call_on_close(lambda: event_hub.unsubscribe(subscriber))
+    return response
+
 @app.route("/api/request_withdrawal", methods=["POST"])
 @login_required
 def request_withdrawal_route():
     data = request.get_json()
-    user = User.query.get(session["user_id"])
+    user = current_user(User.id)
+    tap_accumulator.flush([user.id]) # The caller's buffered taps count towards the balance being withdrawn
+    balance, _ = ledger_balances([user.id])[user.id]
     tokens_to_withdraw = data.get("tokens_to_withdraw")
     payment_method = data.get("payment_method") 
     payment_details = data.get("payment_details") 
@@ -407,38 +2719,70 @@ def request_withdrawal_route():
     if not all([tokens_to_withdraw, payment_method, payment_details]):
         return jsonify({"success": False, "message": "Missing required fields for withdrawal (tokens, payment method, payment details)."}), 400
 
-    if tokens_to_withdraw <= 0 or tokens_to_withdraw > user.cripto_main_tokens:
+    if tokens_to_withdraw <= 0 or tokens_to_withdraw > balance:
         return jsonify({"success": False, "message": "Invalid withdrawal amount or insufficient balance."}), 400
 
-    current_global_price = get_global_setting("current_global_token_price_usd")
-    effective_rate = current_global_price + user.personal_rate_bonus
-    total_usd_value = tokens_to_withdraw * effective_rate
-    commission = total_usd_value * 0.40
-    amount_to_user = total_usd_value * 0.60
+    if app.config["WITHDRAWALS_VIA_QUEUE"]:
+        # Pricing, the guarded debit and the insert happen in a worker; the client polls /api/jobs/<id>
+        job = enqueue_job("withdrawal_request", {"user_id": user.id, "tokens_to_withdraw": tokens_to_withdraw,
+                                                 "payment_method": payment_method,
+                                                 "payment_details": payment_details}, user_id=user.id)
+        db.session.commit()
+        return jsonify({
+            "success": True,
+            "message": "Withdrawal request queued.",
+            "job_id": job.id,
+            "status": job.status
+        }), 202
 
-    user.cripto_main_tokens -= tokens_to_withdraw
-    
-    withdrawal = WithdrawalRequest(
-        user_id=user.id,
-        tokens_to_withdraw=tokens_to_withdraw,
-        global_price_at_withdrawal=current_global_price,
-        personal_bonus_at_withdrawal=user.personal_rate_bonus,
-        total_usd_value_before_commission=total_usd_value,
-        commission_amount_usd=commission,
-        amount_to_user_usd=amount_to_user,
-        payment_method=payment_method,
-        payment_details=payment_details
-    )
-    db.session.add(withdrawal)
+    withdrawal, error = create_withdrawal(user.id, tokens_to_withdraw, payment_method, payment_details)
+    if error:
+        db.session.rollback()
+        return jsonify({"success": False, "message": error}), 400
     db.session.commit()
+    new_balance = publish_balances([user.id])[user.id]
 
     return jsonify({
         "success": True, 
         "message": "Withdrawal request submitted successfully.",
-        "new_token_balance": user.cripto_main_tokens
+        "new_token_balance": new_balance
     })
 
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def job_status_route(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.user_id != session["user_id"] and not session.get("is_admin"):
+        return jsonify({"success": False, "message": "Job not found."}), 404
+    result = json.loads(job.result) if job.result else None
+    response = {"success": True, "job_id": job.id, "kind": job.kind, "status": job.status, "result": result}
+    if result and result.get("withdrawal_request_id"):
+        # Payout status set later by admins flows back through the same endpoint
+        response["withdrawal_status"] = db.session.query(WithdrawalRequest.status)\
+                                              .filter_by(id=result["withdrawal_request_id"]).scalar()
+    return jsonify(response)
+
+@app.route("/api/referrals/team", methods=["GET"])
+@login_required
+def referral_team_route():
+    max_depth = min(max(request.args.get("depth", 3, type=int), 1), app.config["REFERRAL_TEAM_MAX_DEPTH"])
+    user = current_user(User.referral_count, User.downline_count)
+    team = referral_team(user.id, max_depth, app.config["REFERRAL_TEAM_MAX_MEMBERS"])
+    return jsonify({"success": True, "referral_count": user.referral_count,
+                    "downline_count": user.downline_count, **team})
+
+@app.route("/admin/referrals/<int:user_id>/tree")
+@use_read_replica
+@admin_required
+def admin_referral_tree(user_id):
+    user = User.query.get_or_404(user_id)
+    max_depth = min(max(request.args.get("depth", 3, type=int), 1), app.config["REFERRAL_TEAM_MAX_DEPTH"])
+    team = referral_team(user.id, max_depth, app.config["REFERRAL_TEAM_MAX_MEMBERS"])
+    return jsonify({"success": True, "username": user.username, "referral_count": user.referral_count,
+                    "downline_count": user.downline_count, **team})
+
 @app.route("/api/price_history", methods=["GET"])
+@use_read_replica
 @login_required 
 def price_history_route():
     days_filter = request.args.get("days", 30, type=int)
@@ -450,99 +2794,213 @@ def price_history_route():
         
     return jsonify([{"timestamp": h.timestamp.isoformat(), "price_usd": round(h.price_usd, 3), "reason": h.reason} for h in history])
 
+@app.route("/api/price_history/ohlc", methods=["GET"])
+@use_read_replica
+@login_required
+def price_history_ohlc_route():
+    interval = request.args.get("interval", "hour")
+    if interval not in PRICE_BUCKET_FORMATS:
+        return jsonify({"success": False, "message": "Interval must be one of minute, hour, day."}), 400
+    days_filter = request.args.get("days", 30, type=int)
+    start_date = _truncate_to_interval(datetime.utcnow() - timedelta(days=days_filter), interval)
+
+    etag = price_history_etag(interval, start_date.isoformat())
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        buckets = price_ohlc(interval, start_date)
+        response = jsonify([{"bucket_start": b["bucket_start"].isoformat(), "open": round(b["open"], 3),
+                             "high": round(b["high"], 3), "low": round(b["low"], 3),
+                             "close": round(b["close"], 3), "samples": b["samples"]} for b in buckets])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route("/leaderboard")
+@use_read_replica
+def leaderboard_page():
+    leaderboard.ensure_fresh()
+    my_rank = leaderboard.rank(session["user_id"]) if "user_id" in session else None
+    return render_template("leaderboard.html", top_players=leaderboard.top(50), my_rank=my_rank)
+
+@app.route("/api/leaderboard", methods=["GET"])
+@use_read_replica
+def leaderboard_api():
+    limit = min(max(request.args.get("limit", 10, type=int), 1), app.config["LEADERBOARD_MAX_LIMIT"])
+    leaderboard.ensure_fresh()
+    response = {"success": True, "total_players": len(leaderboard), "top": leaderboard.top(limit)}
+    if "user_id" in session:
+        response["my_rank"] = leaderboard.rank(session["user_id"])
+    return jsonify(response)
+
+@app.route("/metrics")
+def metrics_route():
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return app.response_class("Forbidden\n", status=403, mimetype="text/plain")
+    gauges = (
+        ("criptomain_tap_buffer_users", "Users with taps waiting to be flushed.", tap_accumulator.pending_users()),
+        ("criptomain_sse_streams", "Open Server-Sent Event streams.", event_hub.stream_count()),
+    )
+    return app.response_class(request_metrics.render(gauges) + password_hasher.render_metrics(),
+                              mimetype="text/plain; version=0.0.4")
+
 # --- Admin Routes ---
 @app.route("/admin")
+@use_read_replica
 @admin_required
 def admin_dashboard():
     total_users_count = get_global_setting("total_users", 0, int)
     current_price = get_global_setting("current_global_token_price_usd")
-    active_users_24h = User.query.filter(User.last_login_at >= datetime.utcnow() - timedelta(hours=24)).count()
-    active_users_7d = User.query.filter(User.last_login_at >= datetime.utcnow() - timedelta(days=7)).count()
-    total_tokens_in_circulation = db.session.query(func.sum(User.cripto_main_tokens)).scalar() or 0.0
-    pending_withdrawals_count = WithdrawalRequest.query.filter_by(status="pending").count()
-    total_usd_pending_withdrawal = db.session.query(func.sum(WithdrawalRequest.amount_to_user_usd)).filter_by(status="pending").scalar() or 0.0
-    total_usd_paid_out = db.session.query(func.sum(WithdrawalRequest.amount_to_user_usd)).filter_by(status="processed").scalar() or 0.0
-    total_admin_commission = db.session.query(func.sum(WithdrawalRequest.commission_amount_usd)).filter_by(status="processed").scalar() or 0.0
-    today = datetime.utcnow().date()
-    start_of_week = today - timedelta(days=today.weekday())
-    start_of_month = today.replace(day=1)
-    new_users_today = User.query.filter(User.created_at >= today).count()
-    new_users_this_week = User.query.filter(User.created_at >= start_of_week).count()
-    new_users_this_month = User.query.filter(User.created_at >= start_of_month).count()
+    stats = read_admin_stats()
 
     return render_template("admin/dashboard.html", 
                            total_users_count=total_users_count, 
                            current_price=round(current_price,3) if current_price else 0,
-                           active_users_24h=active_users_24h,
-                           active_users_7d=active_users_7d,
-                           total_tokens_in_circulation=round(total_tokens_in_circulation, 2),
-                           pending_withdrawals_count=pending_withdrawals_count,
-                           total_usd_pending_withdrawal=round(total_usd_pending_withdrawal, 2),
-                           total_usd_paid_out=round(total_usd_paid_out, 2),
-                           total_admin_commission=round(total_admin_commission, 2),
-                           new_users_today=new_users_today,
-                           new_users_this_week=new_users_this_week,
-                           new_users_this_month=new_users_this_month
+                           active_users_24h=stats["active_users_24h"],
+                           active_users_7d=stats["active_users_7d"],
+                           total_tokens_in_circulation=round(stats["tokens_in_circulation"], 2),
+                           pending_withdrawals_count=int(stats["pending_withdrawals_count"]),
+                           total_usd_pending_withdrawal=round(stats["total_usd_pending_withdrawal"], 2),
+                           total_usd_paid_out=round(stats["total_usd_paid_out"], 2),
+                           total_admin_commission=round(stats["total_admin_commission"], 2),
+                           new_users_today=stats["new_users_today"],
+                           new_users_this_week=stats["new_users_this_week"],
+                           new_users_this_month=stats["new_users_this_month"]
                            )
 
 @app.route("/admin/users")
+@use_read_replica
 @admin_required
 def admin_users():
-    page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     search_query = request.args.get("search", "")
-    query = User.query.order_by(User.created_at.desc())
+    query = User.query
     if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(User.username.ilike(search_term) | User.email.ilike(search_term))
-    users_pagination = query.paginate(page=page, per_page=15)
+        query = filter_users_by_search(query, search_query)
+        total = count_cache.count(("users", search_query), query)
+    else:
+        total = get_global_setting("total_users", 0, int) + 1 # Registered players plus the admin account
+    users_pagination = keyset_paginate(query, [(User.created_at, True), (User.id, True)], cursor,
+                                       total=total, total_is_estimate=not search_query)
     return render_template("admin/users.html", users_pagination=users_pagination, search_query=search_query)
 
 @app.route("/admin/withdrawals")
+@use_read_replica
 @admin_required
 def admin_withdrawals():
-    page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     status_filter = request.args.get("status", "pending")
-    query = WithdrawalRequest.query.join(User).order_by(WithdrawalRequest.requested_at.desc())
+    query = WithdrawalRequest.query.join(User).options(db.contains_eager(WithdrawalRequest.user))
     if status_filter != "all":
         query = query.filter(WithdrawalRequest.status == status_filter)
-    
-    withdrawals_pagination = query.paginate(page=page, per_page=15)
+    # The pending total is the maintained dashboard counter and "all" is estimated from the highest id
+    # (requests are never deleted); other filters use a cached COUNT over their status index
+    total_is_estimate = status_filter == "all"
+    if status_filter == "pending":
+        pending = db.session.query(AdminStat.value).filter_by(stat_name="pending_withdrawals_count").scalar()
+        total = int(pending) if pending is not None else count_cache.count(("withdrawals", status_filter), query)
+    elif total_is_estimate:
+        total = db.session.query(db.func.max(WithdrawalRequest.id)).scalar() or 0
+    else:
+        total = count_cache.count(("withdrawals", status_filter), query)
+    withdrawals_pagination = keyset_paginate(query, [(WithdrawalRequest.requested_at, True),
+                                                     (WithdrawalRequest.id, True)], cursor, total=total,
+                                             total_is_estimate=total_is_estimate)
     return render_template("admin/withdrawals.html", withdrawals_pagination=withdrawals_pagination, current_status=status_filter)
 
+def _withdrawal_filter_query(args):
+    # Shared filter for bulk actions and exports: status, payment method and requested_at range
+    query = WithdrawalRequest.query
+    status_filter = args.get("status", "pending")
+    if status_filter != "all":
+        query = query.filter(WithdrawalRequest.status == status_filter)
+    if args.get("payment_method"):
+        query = query.filter(WithdrawalRequest.payment_method == args.get("payment_method"))
+    try:
+        if args.get("requested_after"):
+            query = query.filter(WithdrawalRequest.requested_at >= datetime.fromisoformat(args.get("requested_after")))
+        if args.get("requested_before"):
+            query = query.filter(WithdrawalRequest.requested_at < datetime.fromisoformat(args.get("requested_before")))
+    except ValueError:
+        return None
+    return query
+
+@app.route("/admin/withdrawals/bulk", methods=["POST"])
+@admin_required
+def admin_bulk_withdrawals():
+    action = request.form.get("action")
+    admin_notes = request.form.get("admin_notes", "")
+    if action not in ("processed", "rejected"):
+        flash("Invalid action.", "danger")
+        return redirect(url_for("admin_withdrawals"))
+
+    if request.form.get("apply_to_filter"):
+        query = _withdrawal_filter_query(request.form)
+        if query is None:
+            flash("Invalid date filter.", "danger")
+            return redirect(url_for("admin_withdrawals"))
+        request_ids = [row.id for row in query.filter(WithdrawalRequest.status == "pending")
+                                              .with_entities(WithdrawalRequest.id).with_for_update()]
+    else:
+        request_ids = request.form.getlist("request_ids", type=int)
+    if not request_ids:
+        flash("No withdrawal requests selected.", "warning")
+        return redirect(url_for("admin_withdrawals"))
+
+    if app.config["WITHDRAWALS_VIA_QUEUE"] and len(request_ids) > app.config["WITHDRAWAL_BULK_ASYNC_THRESHOLD"]:
+        job = enqueue_job("withdrawal_action", {"request_ids": request_ids, "action": action,
+                                                "admin_notes": admin_notes}, user_id=session["user_id"])
+        db.session.commit()
+        flash(f"{len(request_ids)} withdrawal request(s) queued as job #{job.id}.", "info")
+        return redirect(url_for("admin_withdrawals"))
+
+    actioned = apply_withdrawal_action(request_ids, action, admin_notes)
+    flash(f"{actioned} withdrawal request(s) marked as {action}. {len(request_ids) - actioned} skipped (not pending).", "success")
+    return redirect(url_for("admin_withdrawals", status=action))
+
+@app.route("/admin/withdrawals/export")
+@use_read_replica
+@admin_required
+def admin_export_withdrawals():
+    export_format = request.args.get("format", "csv")
+    if export_format not in ("csv", "jsonl"):
+        return jsonify({"success": False, "message": "Format must be csv or jsonl."}), 400
+    query = _withdrawal_filter_query(request.args)
+    if query is None:
+        return jsonify({"success": False, "message": "Invalid date filter."}), 400
+    query = query.join(User).with_entities(WithdrawalRequest, User.username)\
+                 .order_by(WithdrawalRequest.id.asc()).execution_options(stream_results=True)
+    mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    filename = f"withdrawals-{datetime.utcnow():%Y%m%d%H%M%S}.{export_format}"
+    return app.response_class(stream_with_context(iter_withdrawal_export(query, export_format)), mimetype=mimetype,
+                              headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 @app.route("/admin/withdrawal/<int:request_id>/process", methods=["POST"])
 @admin_required
 def admin_process_withdrawal(request_id):
     withdrawal = WithdrawalRequest.query.get_or_404(request_id)
-    action = request.form.get("action") 
+    action = request.form.get("action")
     admin_notes = request.form.get("admin_notes", "")
+    if action not in ("processed", "rejected"):
+        flash("Invalid action.", "danger")
+        return redirect(url_for("admin_withdrawals"))
 
-    if withdrawal.status != "pending":
+    # Same guarded path as bulk actions: a request already actioned (or actioned concurrently) is skipped
+    username = withdrawal.user.username if withdrawal.user else None
+    if not apply_withdrawal_action([request_id], action, admin_notes):
         flash("This request has already been actioned.", "warning")
         return redirect(url_for("admin_withdrawals"))
-
     if action == "processed":
-        withdrawal.status = "processed"
-        withdrawal.processed_at = datetime.utcnow()
-        withdrawal.admin_notes = admin_notes
-        flash(f"Withdrawal request #{withdrawal.id} for user {withdrawal.user.username} marked as processed.", "success")
-    elif action == "rejected":
-        withdrawal.status = "rejected"
-        withdrawal.processed_at = datetime.utcnow() 
-        withdrawal.admin_notes = admin_notes
-        user = User.query.get(withdrawal.user_id)
-        if user:
-            user.cripto_main_tokens += withdrawal.tokens_to_withdraw
-            flash(f"Withdrawal request #{withdrawal.id} for user {withdrawal.user.username} marked as rejected. Tokens returned to user.", "info")
-        else:
-            flash(f"Withdrawal request #{withdrawal.id} marked as rejected. User not found for token return.", "danger")
+        flash(f"Withdrawal request #{request_id} for user {username} marked as processed.", "success")
+    elif username:
+        flash(f"Withdrawal request #{request_id} for user {username} marked as rejected. Tokens returned to user.", "info")
     else:
-        flash("Invalid action.", "danger")
-        return redirect(url_for("admin_withdrawals"))
-
-    db.session.commit()
-    return redirect(url_for("admin_withdrawals", status=withdrawal.status))
+        flash(f"Withdrawal request #{request_id} marked as rejected. User not found for token return.", "danger")
+    return redirect(url_for("admin_withdrawals", status=action))
 
 @app.route("/admin/tokenomics")
+@use_read_replica
 @admin_required
 def admin_tokenomics():
     settings = GlobalSetting.query.all()
@@ -550,24 +3008,27 @@ def admin_tokenomics():
     return render_template("admin/tokenomics.html", settings=settings, price_history=price_history)
 
 @app.route("/admin/referrals")
+@use_read_replica
 @admin_required
 def admin_referrals():
-    page = request.args.get("page", 1, type=int)
-    
-    total_referrals_made = Referral.query.count()
-    number_of_referrers = db.session.query(func.count(func.distinct(Referral.referrer_user_id))).scalar() or 0
+    cursor = request.args.get("cursor")
+
+    stats = read_admin_stats()
+    total_referrals_made = int(stats["total_referrals"])
+    number_of_referrers = int(stats["referrers_count"])
     average_referrals_per_referrer = (total_referrals_made / number_of_referrers) if number_of_referrers > 0 else 0
 
+    # Served by ix_user_referral_count_id, walked backwards (both keys descending), instead of a GROUP BY
+    # over every Referral row; ties are listed newest first
     top_referrers_query = db.session.query(
+        User.id,
         User.username,
         User.email,
         User.personal_rate_bonus,
-        func.count(Referral.id).label("referral_count")
-    ).join(Referral, User.id == Referral.referrer_user_id)\
-     .group_by(User.id)\
-     .order_by(func.count(Referral.id).desc())
-    
-    top_referrers_pagination = top_referrers_query.paginate(page=page, per_page=15)
+        User.referral_count
+    ).filter(User.referral_count > 0)
+    top_referrers_pagination = keyset_paginate(top_referrers_query, [(User.referral_count, True), (User.id, True)],
+                                               cursor, total=number_of_referrers)
     return render_template("admin/referrals.html", 
                            top_referrers_pagination=top_referrers_pagination,
                            total_referrals_made=total_referrals_made,
@@ -575,9 +3036,409 @@ def admin_referrals():
                            average_referrals_per_referrer=round(average_referrals_per_referrer, 2)
                            )
 
-if __name__ == "__main__":
+# --- Scale Testing ---
+class EventRecorder:
+    """Appends registrations and taps to EVENT_LOG_PATH (JSON lines) so real traffic can be replayed."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, event_type, **fields):
+        path = self.app.config["EVENT_LOG_PATH"]
+        if not path:
+            return
+        line = json.dumps(dict(fields, type=event_type, ts=time.time())) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(path, "a", buffering=1)
+            self._file.write(line)
+
+event_recorder = EventRecorder(app)
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+def _sync_id_sequences(*models):
+    # Rows were inserted with explicit ids; PostgreSQL sequences must be moved past them
+    if db.engine.dialect.name == "postgresql":
+        for model in models:
+            table = model.__tablename__
+            db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                    f"(SELECT COALESCE(MAX(id), 1) FROM \"{table}\"))"))
+
+def generate_synthetic_data(users, seed=1, days=90, tap_sessions=10, referral_rate=0.6, withdrawal_rate=0.2,
+                            batch_size=5000, password="synthetic-pass", until=None, progress=print):
+    # Deterministic for a given seed, `until` and starting database. Users join at an even pace over `days`;
+    # each has tap sessions in the ledger (with a matching balance snapshot), an optional referrer
+    # among earlier users, a registration price row and, sometimes, withdrawals in every status.
+    rng = random.Random(seed)
+    prefix = f"synth{seed}_"
+    if db.session.query(User.id).filter(User.username == f"{prefix}0").first():
+        raise click.ClickException(f"Users for seed {seed} already exist; use another --seed.")
+    now = until or datetime.utcnow().replace(microsecond=0)
+    span = timedelta(days=days).total_seconds()
+    start = now - timedelta(days=days)
+    first_user_id = _next_id(User)
+    entry_id = _next_id(LedgerEntry)
+    withdrawal_id = _next_id(WithdrawalRequest)
+    existing_users = get_global_setting("total_users", 0, int)
+    initial_price = get_global_setting("initial_token_price_usd")
+    increment = get_global_setting("price_increment_per_user_usd")
+    password_hash = password_hasher.hash(password) # One KDF run shared by every synthetic account
+
+    # Referrers are chosen up front so each user's bonus is known when its row is written
+    referrers = [None] * users
+    referral_counts = [0] * users
+    for i in range(1, users):
+        if rng.random() < referral_rate:
+            referrers[i] = rng.randrange(i)
+            referral_counts[referrers[i]] += 1
+
+    tables = (User.__table__, Referral.__table__, TokenPriceHistory.__table__, WithdrawalRequest.__table__,
+              LedgerEntry.__table__, BalanceSnapshot.__table__)
+    for batch_start in range(0, users, batch_size):
+        rows = {table: [] for table in tables}
+        for i in range(batch_start, min(users, batch_start + batch_size)):
+            user_id = first_user_id + i
+            username = f"{prefix}{i}"
+            created_at = start + timedelta(seconds=span * i / users)
+            bonus = round(0.01 * referral_counts[i], 2)
+            price = initial_price + increment * (existing_users + i + 1)
+            taps = 0
+            balance_micro = 0
+            last_entry_id = 0
+            for _ in range(rng.randint(0, 2 * tap_sessions)):
+                count = rng.randint(1, 300)
+                taps += count
+                rows[LedgerEntry.__table__].append({
+                    "id": entry_id, "user_id": user_id, "kind": "tap_credit", "amount_micro": count * MICRO_PER_TAP,
+                    "reference_id": None, "created_at": created_at + (now - created_at) * rng.random()})
+                last_entry_id, entry_id = entry_id, entry_id + 1
+            balance_micro += (taps // TAPS_PER_TOKEN) * MICRO_PER_TOKEN
+            if balance_micro >= MICRO_PER_TOKEN and rng.random() < withdrawal_rate:
+                tokens = rng.randint(1, balance_micro // MICRO_PER_TOKEN)
+                status = rng.choice(("pending", "processed", "rejected"))
+                requested_at = created_at + (now - created_at) * rng.random()
+                total_usd = tokens * (price + bonus)
+                commission = total_usd * 0.40
+                rows[WithdrawalRequest.__table__].append({
+                    "id": withdrawal_id, "user_id": user_id, "tokens_to_withdraw": float(tokens),
+                    "tokens_to_withdraw_micro": tokens * MICRO_PER_TOKEN, "global_price_at_withdrawal": price,
+                    "personal_bonus_at_withdrawal": bonus, "total_usd_value_before_commission": total_usd,
+                    "commission_percentage": 0.40, "commission_amount_usd": commission,
+                    "amount_to_user_usd": total_usd - commission, "payment_method": rng.choice(("crypto", "card", "paypal")),
+                    "payment_details": f"synthetic-{user_id}", "status": status, "requested_at": requested_at,
+                    "processed_at": None if status == "pending" else requested_at + timedelta(hours=rng.randint(1, 48)),
+                    "admin_notes": None})
+                kinds = [("withdrawal_debit", -tokens * MICRO_PER_TOKEN)]
+                if status == "rejected":
+                    kinds.append(("withdrawal_refund", tokens * MICRO_PER_TOKEN))
+                for kind, amount in kinds:
+                    rows[LedgerEntry.__table__].append({
+                        "id": entry_id, "user_id": user_id, "kind": kind, "amount_micro": amount,
+                        "reference_id": withdrawal_id, "created_at": requested_at})
+                    balance_micro += amount
+                    last_entry_id, entry_id = entry_id, entry_id + 1
+                withdrawal_id += 1
+            referrer_id = first_user_id + referrers[i] if referrers[i] is not None else None
+            rows[User.__table__].append({
+                "id": user_id, "username": username, "email": f"{username}@synthetic.local",
+                "password_hash": password_hash, "referral_code": str(uuid.UUID(int=rng.getrandbits(128))),
+                "referred_by_user_id": referrer_id, "personal_rate_bonus": bonus, "created_at": created_at,
+                "last_login_at": created_at + (now - created_at) * rng.random() if rng.random() < 0.8 else None,
+                "is_admin": False, "display_name": username, "cripto_main_tokens": balance_micro / MICRO_PER_TOKEN,
+                "taps_for_next_token": taps % TAPS_PER_TOKEN, "referral_count": referral_counts[i], "downline_count": 0})
+            rows[BalanceSnapshot.__table__].append({
+                "user_id": user_id, "balance_micro": balance_micro, "tap_micro": (taps % TAPS_PER_TOKEN) * MICRO_PER_TAP,
+                "last_entry_id": last_entry_id, "updated_at": now})
+            if referrer_id:
+                rows[Referral.__table__].append({"referrer_user_id": referrer_id, "referred_user_id": user_id,
+                                                 "created_at": created_at})
+            rows[TokenPriceHistory.__table__].append({"price_usd": price, "timestamp": created_at,
+                                                      "reason": f"New user: {username} (ID: {user_id})"})
+        for table in tables: # Parents first: users before the rows that reference them
+            if rows[table]:
+                db.session.execute(table.insert(), rows[table])
+        db.session.commit()
+        progress(f"  {min(users, batch_start + batch_size)}/{users} users")
+
+    _sync_id_sequences(User, WithdrawalRequest, LedgerEntry)
+    total_users = existing_users + users
+    set_global_setting("total_users", total_users)
+    set_global_setting("current_global_token_price_usd", initial_price + increment * total_users)
+    db.session.commit()
+    progress("Rebuilding the referral tree and dashboard counters...")
+    rebuild_referral_tree()
+    reconcile_admin_stats()
+    return first_user_id, entry_id - 1
+
+@app.cli.command("generate-data")
+@click.option("--users", default=10000, help="Synthetic players to create.")
+@click.option("--seed", default=1, help="Random seed; the same seed on the same database gives the same data.")
+@click.option("--days", default=90, help="Spread registrations over this many past days.")
+@click.option("--tap-sessions", default=10, help="Average tap sessions (ledger entries) per player.")
+@click.option("--referral-rate", default=0.6, help="Share of players referred by an earlier player.")
+@click.option("--withdrawal-rate", default=0.2, help="Share of players with a withdrawal request.")
+@click.option("--batch-size", default=5000, help="Players written per executemany batch.")
+@click.option("--password", default="synthetic-pass", help="Password shared by every synthetic player.")
+@click.option("--until", type=click.DateTime(), default=None,
+              help="Timestamp the generated history ends at (default: now); fix it for byte-identical runs.")
+def generate_data_command(users, seed, days, tap_sessions, referral_rate, withdrawal_rate, batch_size, password, until):
+    """Bulk-insert synthetic players, referral chains, tap ledgers, prices and withdrawals."""
+    started = time.perf_counter()
+    generate_synthetic_data(users, seed, days, tap_sessions, referral_rate, withdrawal_rate, batch_size, password, until)
+    print(f"Generated {users} players with seed {seed} in {time.perf_counter() - started:.1f}s.")
+
+@app.cli.command("generate-event-log")
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--users", default=1000, help="Registrations in the log.")
+@click.option("--taps", default=20000, help="Tap events in the log.")
+@click.option("--max-batch", default=20, help="Largest tap count in one event.")
+@click.option("--seed", default=1, help="Random seed.")
+def generate_event_log_command(output, users, taps, max_batch, seed):
+    """Write a synthetic event log in the EVENT_LOG_PATH format, for `flask replay-events`."""
+    rng = random.Random(seed)
+    registered = []
+    remaining_users, remaining_taps = users, taps
+    with open(output, "w") as f:
+        while remaining_users or remaining_taps:
+            # Interleave so registrations keep arriving while earlier players tap
+            if remaining_users and (not registered or not remaining_taps
+                                    or rng.random() < remaining_users / (remaining_users + remaining_taps)):
+                username = f"player{len(registered)}"
+                referrer = rng.choice(registered) if registered and rng.random() < 0.5 else None
+                event = {"type": "register", "username": username, "email": f"{username}@replay.local",
+                         "referrer": referrer}
+                registered.append(username)
+                remaining_users -= 1
+            else:
+                event = {"type": "tap", "username": rng.choice(registered), "count": rng.randint(1, max_batch)}
+                remaining_taps -= 1
+            f.write(json.dumps(event) + "\n")
+    print(f"Wrote {users + taps} events to {output}.")
+
+def replay_events(lines, rate=0.0, threads=4, prefix="", password="replay-pass", progress=print):
+    # Sends each event through the full WSGI stack with one test client per player. A player's events
+    # always go to the same thread so they stay in order; each player gets its own client address.
+    results = {} # event type -> {"latencies": [...], "statuses": {code: n}}
+    results_lock = threading.Lock()
+    queues = [queue.Queue(maxsize=1000) for _ in range(threads)]
+
+    def client_for(clients, username):
+        client = clients.get(username)
+        if client is None:
+            client = clients[username] = app.test_client()
+            digest = zlib.crc32(username.encode())
+            client.environ_base["REMOTE_ADDR"] = f"10.{digest >> 16 & 255}.{digest >> 8 & 255}.{digest & 255}"
+        return client
+
+    def send(clients, event):
+        username = prefix + event["username"]
+        client = client_for(clients, username)
+        if event["type"] == "register":
+            referral_code = ""
+            if event.get("referrer"):
+                with app.app_context():
+                    referral_code = db.session.query(User.referral_code)\
+                                              .filter_by(username=prefix + event["referrer"]).scalar() or ""
+            return client.post("/register", data={"username": username, "password": password,
+                                                  "email": prefix + event.get("email", f"{event['username']}@replay.local"),
+                                                  "referral_code": referral_code})
+        if event["type"] == "tap":
+            response = client.post("/api/record_taps", json={"count": event.get("count", 1)})
+            if response.status_code == 302: # Not logged in yet (player registered outside the log)
+                client.post("/login", data={"username": username, "password": password})
+                response = client.post("/api/record_taps", json={"count": event.get("count", 1)})
+            return response
+        return None
+
+    def worker(work):
+        clients = {}
+        while True:
+            event = work.get()
+            if event is None:
+                return
+            started = time.perf_counter()
+            response = send(clients, event)
+            latency = time.perf_counter() - started
+            if response is None:
+                continue
+            with results_lock:
+                result = results.setdefault(event["type"], {"latencies": [], "statuses": {}})
+                result["latencies"].append(latency)
+                result["statuses"][response.status_code] = result["statuses"].get(response.status_code, 0) + 1
+
+    pool = [threading.Thread(target=worker, args=(work,), daemon=True) for work in queues]
+    for thread in pool:
+        thread.start()
+    started = time.perf_counter()
+    sent = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        event = json.loads(line)
+        if rate:
+            delay = started + sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        queues[zlib.crc32(event["username"].encode()) % threads].put(event)
+        sent += 1
+        if sent % 10000 == 0:
+            progress(f"  {sent} events sent")
+    for work in queues:
+        work.put(None)
+    for thread in pool:
+        thread.join()
+    tap_accumulator.flush()
+    return sent, time.perf_counter() - started, results
+
+@app.cli.command("replay-events", with_appcontext=False)
+@click.argument("log_file", type=click.File("r"))
+@click.option("--rate", default=0.0, help="Events per second (0 = as fast as possible).")
+@click.option("--threads", default=4, help="Concurrent replay threads.")
+@click.option("--prefix", default="", help="Prepended to every username, so a log can be replayed more than once.")
+@click.option("--password", default="replay-pass", help="Password for replayed registrations and logins.")
+def replay_events_command(log_file, rate, threads, prefix, password):
+    """Replay a registration/tap event log through the real request handlers."""
+    configure_app()
+    sent, elapsed, results = replay_events(log_file, rate, threads, prefix, password)
+    print(f"Replayed {sent} events in {elapsed:.1f}s ({sent / elapsed if elapsed else 0:.1f} events/s).")
+    for event_type, result in sorted(results.items()):
+        latencies = sorted(result["latencies"])
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        statuses = ", ".join(f"{code}: {n}" for code, n in sorted(result["statuses"].items()))
+        print(f"  {event_type:<10} {len(latencies):>8} requests  p50 {p50:.1f} ms  p95 {p95:.1f} ms  [{statuses}]")
+
+# --- Production Server ---
+def run_startup_tasks():
+    # Once per deployment, not per worker: schema and indexes, settings and counter rows, search index and asset build
     with app.app_context():
-        db.create_all()
+        migrate_schema()
         initialize_global_settings()
+        ensure_admin_stats()
+        ensure_user_search_index()
+    asset_pipeline.build()
+
+def warm_worker():
+    # Fills the per-process caches and opens pool connections before the worker accepts traffic
+    with app.app_context():
+        get_global_setting("current_global_token_price_usd")
+        leaderboard.ensure_fresh()
+        for engine in db.engines.values():
+            size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+            connections = [engine.connect() for _ in range(max(1, min(size, 4)))]
+            for connection in connections:
+                connection.close()
+    asset_pipeline.ensure_built()
+    password_hasher.warm()
+
+def _release_process_resources():
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+def _serve_worker(listener, threaded, inline_jobs):
+    # Runs in a forked child; returns the exit code. The master's handlers must not run here.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The master relays Ctrl-C as SIGTERM
+    server = make_server(*listener.getsockname()[:2], app, threaded=threaded, fd=listener.fileno())
+    # Join in-flight requests on shutdown instead of dropping them with the process
+    server.daemon_threads = False
+    server.block_on_close = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    warm_worker()
+    if inline_jobs:
+        start_inline_worker()
+    app.logger.info("Worker %s ready.", os.getpid())
+    server.serve_forever()
+    event_hub.close_all()
+    server.server_close()
+    tap_accumulator.flush()
+    password_hasher.shutdown()
+    _release_process_resources()
+    return 0
+
+def serve(host, port, workers, threaded=True, inline_jobs=False, graceful_timeout=30.0):
+    """Pre-fork server: the master runs startup work, binds the socket and supervises the workers."""
+    configure_app()
+    run_startup_tasks()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(2048)
+    # Nothing that cannot survive a fork is carried into the workers
+    password_hasher.shutdown()
+    _release_process_resources()
+
+    children = set()
+    stopping = threading.Event()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = _serve_worker(listener, threaded, inline_jobs)
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        if stopping.is_set():
+            return
+        stopping.set()
+        print(f"Stopping {len(children)} workers...")
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+        def force_kill():
+            for pid in list(children):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        timer = threading.Timer(graceful_timeout, force_kill)
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"Serving on http://{host}:{port} with {workers} workers (master {os.getpid()}).")
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping.is_set():
+            print(f"Worker {pid} exited with status {status}; restarting.")
+            time.sleep(1) # Avoid a tight respawn loop if workers crash on start
+            spawn()
+    listener.close()
+
+@app.cli.command("serve", with_appcontext=False)
+@click.option("--host", default="0.0.0.0", help="Interface to bind.")
+@click.option("--port", default=8000, help="Port to bind.")
+@click.option("--workers", default=os.cpu_count() or 1, help="Worker processes to pre-fork.")
+@click.option("--threads/--no-threads", default=True, help="Handle requests on threads inside each worker.")
+@click.option("--inline-jobs/--no-inline-jobs", default=False,
+              help="Also drain the job queue inside each worker. Off by default: run `flask run-worker` "
+                   "processes and scale them on their own, so idle web workers do not poll the queue.")
+@click.option("--graceful-timeout", default=30.0, help="Seconds to let workers finish before killing them.")
+def serve_command(host, port, workers, threads, inline_jobs, graceful_timeout):
+    """Run the production server: startup work once, then pre-forked, pre-warmed workers."""
+    serve(host, port, workers, threaded=threads, inline_jobs=inline_jobs, graceful_timeout=graceful_timeout)
+
+if __name__ == "__main__":
+    configure_app()
+    run_startup_tasks()
+    if app.config["WITHDRAWALS_VIA_QUEUE"]:
+        start_inline_worker() # Development server only; production runs `flask run-worker` separately
     app.run(host="0.0.0.0", port=5000, debug=True)
 
@@ -0,0 +1,213 @@
+# backend/benchmark.py
+"""Load benchmark for the hot endpoints.
+
+Runs virtual users against the Flask test client backed by a throwaway SQLite database and
+reports requests/s, p50/p95/p99 latency and SQL statements per request for each endpoint.
+
+    python benchmark.py --users 20 --iterations 50 --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ADMIN_PASSWORD = "bench-admin-pass"
+
+
+def percentile(sorted_values, pct):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {} # endpoint -> list of (latency_seconds, sql_statements, ok)
+
+    def add(self, endpoint, latency, statements, ok):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append((latency, statements, ok))
+
+    def summary(self, duration):
+        endpoints = {}
+        all_latencies = []
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = sorted(s[0] for s in samples)
+            all_latencies.extend(latencies)
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "errors": sum(1 for s in samples if not s[2]),
+                "rps": round(len(samples) / duration, 2),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+                "sql_per_request": round(sum(s[1] for s in samples) / len(samples), 2),
+            }
+        all_latencies.sort()
+        total = {
+            "requests": len(all_latencies),
+            "rps": round(len(all_latencies) / duration, 2),
+            "p50_ms": round(percentile(all_latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(all_latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(all_latencies, 99) * 1000, 3),
+        }
+        return endpoints, total
+
+
+def setup_app(db_path):
+    # Settings without a config key (the admin account) are read from the environment
+    os.environ.setdefault("ADMIN_PASSWORD", ADMIN_PASSWORD)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    from sqlalchemy import event
+
+    flask_app = app_module.configure_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path,
+        "PROPAGATE_EXCEPTIONS": False, # Count failures as 500s instead of aborting the run
+        "WITHDRAWALS_VIA_QUEUE": True,
+        "TAP_RATE_LIMIT_ENABLED": False, # Virtual users tap far faster than the per-user limit
+    })
+    counter = threading.local()
+    with flask_app.app_context():
+        app_module.db.create_all()
+        app_module.initialize_global_settings()
+
+        @event.listens_for(app_module.db.engine, "before_cursor_execute")
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            counter.statements = getattr(counter, "statements", 0) + 1
+
+    return app_module, counter
+
+
+def run_benchmark(args):
+    fd, db_path = tempfile.mkstemp(suffix=".db", prefix="criptomain-bench-")
+    os.close(fd)
+    try:
+        app_module, counter = setup_app(db_path)
+        flask_app = app_module.app
+        recorder = Recorder()
+
+        def timed(endpoint, call):
+            counter.statements = 0
+            start = time.perf_counter()
+            response = call()
+            latency = time.perf_counter() - start
+            recorder.add(endpoint, latency, counter.statements, response.status_code < 500)
+            return response
+
+        def virtual_user(index):
+            client = flask_app.test_client()
+            username = f"bench_{index}_{os.getpid()}"
+            timed("/register", lambda: client.post("/register", data={
+                "username": username, "email": f"{username}@bench.local", "password": "bench-pass"}))
+            client.get("/logout")
+            timed("/login", lambda: client.post("/login", data={"username": username, "password": "bench-pass"}))
+            for _ in range(args.iterations):
+                timed("/api/game_state", lambda: client.get("/api/game_state"))
+                for _ in range(args.taps):
+                    timed("/api/record_tap", lambda: client.post("/api/record_tap"))
+
+        def admin_user(stop):
+            client = flask_app.test_client()
+            client.post("/login", data={"username": os.environ.get("ADMIN_USERNAME", "admin"),
+                                        "password": os.environ["ADMIN_PASSWORD"]})
+            while not stop.is_set():
+                timed("/admin", lambda: client.get("/admin"))
+                stop.wait(args.admin_interval)
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=virtual_user, args=(i,)) for i in range(args.users)]
+        admin_threads = [threading.Thread(target=admin_user, args=(stop,)) for _ in range(args.admins)]
+        start = time.perf_counter()
+        for t in threads + admin_threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stop.set()
+        for t in admin_threads:
+            t.join()
+        duration = time.perf_counter() - start
+        app_module.tap_accumulator.flush()
+
+        endpoints, total = recorder.summary(duration)
+        return {
+            "meta": {
+                "commit": git_commit(),
+                "timestamp": datetime.utcnow().isoformat(),
+                "duration_seconds": round(duration, 3),
+                "users": args.users,
+                "iterations": args.iterations,
+                "taps_per_iteration": args.taps,
+                "admins": args.admins,
+            },
+            "endpoints": endpoints,
+            "total": total,
+        }
+    finally:
+        os.remove(db_path)
+
+
+def print_report(results, baseline=None):
+    header = f"{'endpoint':<20}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sql/req':>9}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in results["endpoints"].items():
+        print(f"{endpoint:<20}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['sql_per_request']:>9}")
+        old = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if old:
+            deltas = []
+            for key in ("rps", "p95_ms", "sql_per_request"):
+                if old[key]:
+                    deltas.append(f"{key} {100.0 * (row[key] - old[key]) / old[key]:+.1f}%")
+            print(f"{'':<20}vs {baseline['meta'].get('commit') or 'baseline'}: " + ", ".join(deltas))
+    total = results["total"]
+    print("-" * len(header))
+    print(f"{'total':<20}{total['requests']:>10}{'':>8}{total['rps']:>10}"
+          f"{total['p50_ms']:>10}{total['p95_ms']:>10}{total['p99_ms']:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CriptoMain hot endpoints.")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent virtual players.")
+    parser.add_argument("--iterations", type=int, default=20, help="Game-state polls per player.")
+    parser.add_argument("--taps", type=int, default=5, help="Taps sent after each poll.")
+    parser.add_argument("--admins", type=int, default=1, help="Concurrent admins reloading the dashboard.")
+    parser.add_argument("--admin-interval", type=float, default=0.05, help="Seconds between dashboard loads.")
+    parser.add_argument("--output", help="Write results as JSON to this file.")
+    parser.add_argument("--compare", help="Previous results JSON to compare against.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
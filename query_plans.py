@@ -0,0 +1,325 @@
+# backend/query_plans.py
+"""Query-plan regression check for the request paths.
+
+Seeds a throwaway SQLite database with synthetic players, drives every page and API endpoint (plus the
+tap flush and job worker) through the Flask test client, captures each SQL statement they issue and runs
+EXPLAIN QUERY PLAN on it. Exits with status 1 if any statement reads a table with a full scan, or if a
+page deep into a keyset-paginated list does not seek its index to the cursor, so a change cannot
+silently turn a page load back into an O(n) read. --timings also compares the wall-clock cost of the
+first and the deep pages (too noisy for CI, useful when changing pagination).
+
+    python query_plans.py
+    python query_plans.py --users 20000 --show-plans --output plans.json
+    python query_plans.py --users 200000 --timings
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+# Tables that stay small by design; scanning them is fine
+SMALL_TABLES = {"global_setting", "admin_stat", "stat_bucket"}
+# Maintenance steps that read whole tables by design; a statement is exempt only if nothing else issues it
+WHOLE_TABLE_STEPS = {"leaderboard rebuild", "snapshot-ledger", "reconcile-stats", "compact-price-history"}
+# Deep keyset pages and the (table, first key column) their index must seek to with "column<?"
+SEEK_STEPS = {"GET /admin/users (deep page)": ("user", "created_at"),
+              "GET /admin/withdrawals (deep page)": ("withdrawal_request", "requested_at"),
+              "GET /admin/referrals (deep page)": ("user", "referral_count")}
+# With --timings, a page near the end of a keyset list may be at most this much slower than the first one
+DEEP_PAGE_SLOWDOWN = 3.0
+DEEP_PAGE_SLACK_SECONDS = 0.0005
+SCAN_RE = re.compile(r"^SCAN (\w+)")
+OFFSET_RE = re.compile(r" OFFSET (\?|\d+) ")
+EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT INTO")
+
+
+def full_scans(plan_rows, table_names, statement, parameters):
+    # "SCAN t" is a full table read. "SCAN t USING [COVERING] INDEX" walks an index in order, which is only
+    # bounded when the statement stops after a LIMIT: with a top-level WHERE (rows filtered during the walk)
+    # or a non-zero OFFSET (rows skipped) it can still read most of the table, so those are flagged too.
+    # Virtual tables (FTS) have their own index.
+    outer = top_level(statement)
+    bounded_walk = " LIMIT " in outer and " WHERE " not in outer and not offset(outer, parameters)
+    scans = []
+    for row in plan_rows:
+        detail = row[-1]
+        match = SCAN_RE.match(detail)
+        if not match or "VIRTUAL TABLE" in detail or ("USING" in detail and bounded_walk):
+            continue
+        table = match.group(1)
+        if table in table_names and table not in SMALL_TABLES:
+            scans.append(detail)
+    return scans
+
+
+def seeks(plan, table, column):
+    # A keyset page reads per_page + 1 rows only if the index search starts at the cursor
+    pattern = re.compile(rf"^SEARCH {table} USING (COVERING )?INDEX \w+ \(.*\b{column}<\?\)")
+    return any(pattern.match(line) for line in plan)
+
+
+def offset(outer, parameters):
+    # The SQLite dialect renders every LIMIT as "LIMIT ? OFFSET ?" and binds 0 when there is no offset
+    match = OFFSET_RE.search(outer)
+    if not match:
+        return 0
+    if match.group(1) != "?":
+        return int(match.group(1))
+    return parameters[-1] if isinstance(parameters, (list, tuple)) and parameters else 1
+
+
+def top_level(statement):
+    # The statement with every parenthesized part (subqueries, function arguments) removed
+    depth, kept = 0, []
+    for char in statement:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0:
+            kept.append(char)
+    return " " + " ".join("".join(kept).upper().split()) + " "
+
+
+def setup_app(db_path, users):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+
+    flask_app = app_module.configure_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path,
+        "PROPAGATE_EXCEPTIONS": False, # Pages whose templates are missing still run their queries
+        "WITHDRAWALS_VIA_QUEUE": True,
+        "TAP_RATE_LIMIT_ENABLED": False,
+        "PASSWORD_HASH_WORKERS": 0,
+    })
+    with flask_app.app_context():
+        app_module.migrate_schema()
+        app_module.initialize_global_settings()
+        app_module.ensure_user_search_index()
+        app_module.generate_synthetic_data(users, seed=1, progress=lambda message: None)
+    return app_module
+
+
+def drive(app_module, capture):
+    flask_app = app_module.app
+    player = flask_app.test_client()
+    admin = flask_app.test_client()
+    with flask_app.app_context():
+        player_id, username = app_module.db.session.query(app_module.User.id, app_module.User.username)\
+            .filter(app_module.User.referral_count > 0).order_by(app_module.User.id).first()
+        withdrawal_id = app_module.db.session.query(app_module.WithdrawalRequest.id)\
+            .filter_by(status="pending").order_by(app_module.WithdrawalRequest.id.desc()).limit(1).scalar()
+
+    def step(label, call):
+        capture.label = label
+        return call()
+
+    def warm_leaderboard():
+        with flask_app.app_context():
+            app_module.leaderboard.ensure_fresh()
+    step("leaderboard rebuild", warm_leaderboard) # What warm_worker does before a worker takes traffic
+    step("POST /login", lambda: player.post("/login", data={"username": username, "password": "synthetic-pass"}))
+    step("POST /login (admin)", lambda: admin.post("/login", data={"username": os.environ.get("ADMIN_USERNAME", "admin"),
+                                                                   "password": os.environ.get("ADMIN_PASSWORD", "criptoadminpass1234")}))
+    step("POST /register", lambda: flask_app.test_client().post("/register", data={
+        "username": "plan_check", "email": "plan_check@local", "password": "plan-check-pass",
+        "referral_code": ""}))
+    for label, path in (("GET /game", "/game"), ("GET /profile", "/profile"), ("GET /settings", "/settings"),
+                        ("GET /api/user_settings", "/api/user_settings"), ("GET /api/game_state", "/api/game_state"),
+                        ("GET /api/referrals/team", "/api/referrals/team?depth=5"),
+                        ("GET /api/price_history", "/api/price_history?days=30"),
+                        ("GET /api/price_history/ohlc", "/api/price_history/ohlc?interval=hour&days=7"),
+                        ("GET /leaderboard", "/leaderboard"), ("GET /api/leaderboard", "/api/leaderboard")):
+        step(label, lambda path=path: player.get(path))
+    step("POST /api/user_settings", lambda: player.post("/api/user_settings", json={"display_name": "Plan Check"}))
+    step("POST /api/record_tap", lambda: player.post("/api/record_tap"))
+    step("POST /api/record_taps", lambda: player.post("/api/record_taps", json={"count": 150, "seq": 1}))
+    step("tap flush", app_module.tap_accumulator.flush)
+
+    def refresh_leaderboard():
+        with flask_app.app_context():
+            app_module.leaderboard.refresh()
+    step("leaderboard refresh", refresh_leaderboard)
+    response = step("POST /api/request_withdrawal", lambda: player.post("/api/request_withdrawal", json={
+        "tokens_to_withdraw": 1, "payment_method": "crypto", "payment_details": "plan-check"}))
+    job_id = (response.get_json() or {}).get("job_id")
+
+    def run_jobs():
+        with flask_app.app_context():
+            app_module.run_jobs("plan-check")
+    step("job worker", run_jobs)
+    if job_id:
+        step("GET /api/jobs/<id>", lambda: player.get(f"/api/jobs/{job_id}"))
+
+    for label, path in (("GET /admin", "/admin"), ("GET /admin/users", "/admin/users"),
+                        ("GET /admin/users?search", "/admin/users?search=synth1_12"),
+                        ("GET /admin/withdrawals", "/admin/withdrawals"),
+                        ("GET /admin/withdrawals?status=all", "/admin/withdrawals?status=all"),
+                        ("GET /admin/referrals", "/admin/referrals"),
+                        ("GET /admin/referrals/<id>/tree", f"/admin/referrals/{player_id}/tree"),
+                        ("GET /admin/tokenomics", "/admin/tokenomics")):
+        step(label, lambda path=path: admin.get(path))
+    # Follow a cursor deep into each keyset list so the range predicates are checked, not just the first page
+    capture.label = None # The cursor lookups below are setup, not part of any route
+    User, WithdrawalRequest = app_module.User, app_module.WithdrawalRequest
+    with flask_app.app_context():
+        users_cursor, _ = deep_cursor(app_module, User.query, [User.created_at, User.id])
+        withdrawals_cursor, _ = deep_cursor(app_module, WithdrawalRequest.query.filter_by(status="pending"),
+                                         [WithdrawalRequest.requested_at, WithdrawalRequest.id])
+        referrers_cursor, _ = deep_cursor(app_module, User.query.filter(User.referral_count > 0),
+                                       [User.referral_count, User.id])
+    step("GET /admin/users (deep page)", lambda: admin.get(f"/admin/users?cursor={users_cursor}"))
+    step("GET /admin/withdrawals (deep page)", lambda: admin.get(f"/admin/withdrawals?cursor={withdrawals_cursor}"))
+    step("GET /admin/referrals (deep page)", lambda: admin.get(f"/admin/referrals?cursor={referrers_cursor}"))
+    step("POST /admin/withdrawal/<id>/process", lambda: admin.post(
+        f"/admin/withdrawal/{withdrawal_id}/process", data={"action": "rejected", "admin_notes": "plan check"}))
+    step("GET /metrics", lambda: admin.get("/metrics"))
+
+    def maintenance(function):
+        def call():
+            with flask_app.app_context():
+                function()
+        return call
+    step("snapshot-ledger", maintenance(app_module.snapshot_ledger))
+    step("reconcile-stats", maintenance(app_module.reconcile_admin_stats))
+    step("compact-price-history", maintenance(app_module.compact_price_history))
+    capture.label = None
+
+
+class Capture:
+    def __init__(self):
+        self._local = threading.local()
+        self.statements = {} # sql -> {"labels": set(), "parameters": first parameters seen}
+
+    @property
+    def label(self):
+        return getattr(self._local, "label", None)
+
+    @label.setter
+    def label(self, value):
+        self._local.label = value
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        label = self.label
+        if label is None or not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return
+        if statement.lstrip().upper().startswith("INSERT INTO") and " SELECT " not in statement.upper():
+            return # Plain INSERT ... VALUES reads nothing
+        entry = self.statements.setdefault(statement, {"labels": set(), "parameters": None})
+        entry["labels"].add(label)
+        if entry["parameters"] is None:
+            entry["parameters"] = parameters[0] if executemany else parameters
+
+
+def deep_cursor(app_module, query, columns, fraction=0.9):
+    # A "next" cursor pointing at the row fraction of the way through the list, in descending key order
+    depth = int(query.count() * fraction)
+    row = query.with_entities(*columns).order_by(*[c.desc() for c in columns]).offset(depth).first()
+    return app_module.encode_cursor("next", list(row)), depth
+
+
+def deep_page_timings(app_module, repeat=15):
+    # Median time to load a list's first page against a page 90% of the way through it; keyset pages seek
+    # straight to the cursor, so the deep one must cost about the same
+    User, WithdrawalRequest = app_module.User, app_module.WithdrawalRequest
+    lists = (("admin users", User, [User.created_at, User.id]),
+             ("admin withdrawals", WithdrawalRequest, [WithdrawalRequest.requested_at, WithdrawalRequest.id]))
+    timings = []
+    with app_module.app.app_context():
+        for name, model, columns in lists:
+            keys = [(column, True) for column in columns]
+            cursor, depth = deep_cursor(app_module, model.query, columns)
+
+            def median(cursor):
+                samples = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    app_module.keyset_paginate(model.query, keys, cursor)
+                    samples.append(time.perf_counter() - start)
+                    app_module.db.session.expunge_all()
+                return sorted(samples)[len(samples) // 2]
+            median(None) # Warm the statement cache and pages
+            first, deep = median(None), median(cursor)
+            timings.append({"list": name, "depth": depth, "first_page_ms": round(first * 1000, 3),
+                            "deep_page_ms": round(deep * 1000, 3),
+                            "too_slow": deep > first * DEEP_PAGE_SLOWDOWN + DEEP_PAGE_SLACK_SECONDS})
+    return timings
+
+
+def run_check(args):
+    fd, db_path = tempfile.mkstemp(suffix=".db", prefix="criptomain-plans-")
+    os.close(fd)
+    try:
+        app_module = setup_app(db_path, args.users)
+        from sqlalchemy import event
+
+        capture = Capture()
+        with app_module.app.app_context():
+            engine = app_module.db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        # Requests must not share an outer app context, or g (and the cached current user) leaks between clients
+        drive(app_module, capture)
+        with app_module.app.app_context():
+            table_names = set(app_module.db.metadata.tables)
+            connection = app_module.db.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                results = []
+                for statement, entry in capture.statements.items():
+                    plan = cursor.execute("EXPLAIN QUERY PLAN " + statement, entry["parameters"] or ()).fetchall()
+                    results.append({
+                        "routes": sorted(entry["labels"]),
+                        "sql": " ".join(statement.split()),
+                        "plan": [row[-1] for row in plan],
+                        "full_scans": [] if entry["labels"] <= WHOLE_TABLE_STEPS
+                                      else full_scans(plan, table_names, statement, entry["parameters"]),
+                    })
+            finally:
+                connection.close()
+        event.remove(engine, "before_cursor_execute", capture)
+        unseeked = [label for label, (table, column) in SEEK_STEPS.items()
+                    if not any(label in r["routes"] and seeks(r["plan"], table, column) for r in results)]
+        return results, unseeked, deep_page_timings(app_module) if args.timings else []
+    finally:
+        os.remove(db_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fail if any request-path query falls back to a full table scan.")
+    parser.add_argument("--users", type=int, default=5000, help="Synthetic players to seed.")
+    parser.add_argument("--show-plans", action="store_true", help="Print the plan of every captured statement.")
+    parser.add_argument("--output", help="Write every statement and its plan as JSON to this file.")
+    parser.add_argument("--timings", action="store_true",
+                        help="Also fail if a deep keyset page is much slower than the first page (wall clock).")
+    args = parser.parse_args(argv)
+
+    results, unseeked, timings = run_check(args)
+    failures = [r for r in results if r["full_scans"]]
+    slow_pages = [t for t in timings if t["too_slow"]]
+    for result in results:
+        if result["full_scans"] or args.show_plans:
+            print(("FULL SCAN " if result["full_scans"] else "ok        ") + ", ".join(result["routes"]))
+            print("    " + result["sql"][:300])
+            for line in result["plan"]:
+                print("      " + line)
+    for label in unseeked:
+        print(f"NO SEEK   {label}: no index search on the cursor's first key column")
+    for timing in timings:
+        print(("SLOW PAGE " if timing["too_slow"] else "ok        ") + f"{timing['list']}: first page "
+              f"{timing['first_page_ms']} ms, row {timing['depth']} {timing['deep_page_ms']} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"statements": results, "unseeked_pages": unseeked, "deep_page_timings": timings}, f, indent=2)
+    print(f"{len(results)} statements checked, {len(failures)} with full table scans, "
+          f"{len(unseeked)} deep pages without an index seek"
+          + (f", {len(slow_pages)} deep pages too slow." if args.timings else "."))
+    return 1 if failures or unseeked or slow_pages else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_usernames = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    # app.py holds one application per process, so every test shares one throwaway SQLite database
+    # and isolates itself with its own users
+    fd, db_path = tempfile.mkstemp(suffix=".db", prefix="criptomain-test-")
+    os.close(fd)
+    import app as app_module
+
+    app_module.configure_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_path,
+        "TESTING": True,
+        "WITHDRAWALS_VIA_QUEUE": False,
+        "TAP_RATE_LIMIT_ENABLED": False,
+        "TAP_FLUSH_INTERVAL_SECONDS": 3600.0, # Tests flush explicitly
+        "PASSWORD_HASH_WORKERS": 0,
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000",
+    })
+    with app_module.app.app_context():
+        app_module.migrate_schema()
+        app_module.initialize_global_settings()
+        app_module.ensure_admin_stats()
+    yield app_module
+    app_module.tap_accumulator.flush()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+@pytest.fixture
+def ctx(app_module):
+    with app_module.app.app_context():
+        yield app_module
+        app_module.db.session.rollback()
+
+
+@pytest.fixture
+def make_user(ctx):
+    def make(taps=0):
+        n = next(_usernames)
+        user = ctx.User(username=f"test_{n}", email=f"test_{n}@test.local", password_hash="!")
+        ctx.db.session.add(user)
+        ctx.db.session.commit()
+        if taps:
+            ctx.tap_accumulator.add(user.id, taps)
+            ctx.tap_accumulator.flush([user.id])
+        return user.id
+    return make
+
+
+@pytest.fixture
+def client(app_module):
+    # A logged-in player; requests must not run inside an outer app context or g leaks between them
+    n = next(_usernames)
+    test_client = app_module.app.test_client()
+    response = test_client.post("/register", data={"username": f"client_{n}", "email": f"client_{n}@test.local",
+                                                   "password": "test-password"})
+    assert response.status_code == 302
+    return test_client
@@ -0,0 +1,27 @@
+import pytest
+
+
+@pytest.fixture
+def no_counters(ctx):
+    ctx.AdminStat.query.delete()
+    ctx.db.session.commit()
+    yield ctx
+    ctx.db.session.rollback()
+    ctx.ensure_admin_stats()
+
+
+def test_read_admin_stats_does_not_write_missing_counters(no_counters):
+    stats = no_counters.read_admin_stats()
+    assert all(stats[name] == 0.0 for name in no_counters.ADMIN_STAT_NAMES)
+    assert no_counters.AdminStat.query.count() == 0
+
+
+def test_ensure_admin_stats_seeds_counters_once(no_counters, make_user):
+    referrer_id = make_user()
+    referred_id = make_user()
+    no_counters.db.session.add(no_counters.Referral(referrer_user_id=referrer_id, referred_user_id=referred_id))
+    no_counters.db.session.commit()
+    assert no_counters.ensure_admin_stats() is True
+    stats = no_counters.read_admin_stats()
+    assert stats["total_referrals"] == no_counters.Referral.query.count()
+    assert no_counters.ensure_admin_stats() is False
@@ -0,0 +1,8 @@
+import pytest
+
+
+def test_configure_app_configures_the_one_module_level_app(app_module):
+    assert app_module.configure_app() is app_module.app
+    with pytest.raises(RuntimeError):
+        app_module.configure_app({"TESTING": False})
+    assert app_module.app.config["TESTING"] is True
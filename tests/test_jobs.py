@@ -0,0 +1,45 @@
+import pytest
+
+
+@pytest.fixture
+def funded_user(ctx, make_user):
+    user_id = make_user(taps=1000) # 10 tokens
+    ctx.leaderboard.rebuild()
+    subscriber = ctx.event_hub.subscribe(user_id)
+    yield user_id, subscriber
+    ctx.event_hub.unsubscribe(subscriber)
+
+
+def run_queued(ctx, kind, payload, user_id=None):
+    job = ctx.enqueue_job(kind, payload, user_id=user_id)
+    ctx.db.session.commit()
+    ctx.run_jobs("test-worker")
+    ctx.db.session.refresh(job)
+    assert job.status == "done", job.result
+    return job
+
+
+def test_queued_withdrawal_and_bulk_reject_publish_balances(ctx, funded_user):
+    user_id, subscriber = funded_user
+    run_queued(ctx, "withdrawal_request", {"user_id": user_id, "tokens_to_withdraw": 4.0,
+                                           "payment_method": "crypto", "payment_details": "test"}, user_id)
+    assert subscriber.drain(0)["balance"] == {"cripto_main_tokens": 6.0}
+    assert ctx.leaderboard._tokens[user_id] == 6.0
+
+    request_id = ctx.WithdrawalRequest.query.filter_by(user_id=user_id).one().id
+    run_queued(ctx, "withdrawal_action", {"request_ids": [request_id], "action": "rejected"})
+    assert subscriber.drain(0)["balance"] == {"cripto_main_tokens": 10.0}
+    assert ctx.leaderboard._tokens[user_id] == 10.0
+
+
+def test_refresh_publishes_balances_changed_in_another_process(ctx, funded_user):
+    user_id, subscriber = funded_user
+    withdrawal, error = ctx.create_withdrawal(user_id, 3.0, "crypto", "test")
+    assert error is None
+    ctx.db.session.commit() # Committed without publishing, like a worker in another process
+    assert subscriber.drain(0) == {}
+
+    ctx.leaderboard._rebuilding = True
+    ctx.leaderboard._refresh_in_background()
+    assert subscriber.drain(0)["balance"] == {"cripto_main_tokens": 7.0}
+    assert ctx.leaderboard._tokens[user_id] == 7.0
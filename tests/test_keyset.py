@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def tied_users(ctx, make_user):
+    # Three users per created_at value, so pages split tied groups
+    ids = [make_user() for _ in range(12)]
+    start = datetime(2020, 1, 1)
+    for i, user_id in enumerate(ids):
+        ctx.db.session.get(ctx.User, user_id).created_at = start + timedelta(minutes=i // 3)
+    ctx.db.session.commit()
+    return ids
+
+
+def walk(ctx, keys, ids, per_page):
+    query = ctx.User.query.filter(ctx.User.id.in_(ids))
+    pages, cursor = [], None
+    with ctx.app.test_request_context():
+        while True:
+            page = ctx.keyset_paginate(query, keys, cursor, per_page=per_page)
+            pages.append([u.id for u in page.items])
+            if not page.next_cursor:
+                break
+            cursor = page.next_cursor
+        back = ctx.keyset_paginate(query, keys, page.prev_cursor, per_page=per_page) if page.prev_cursor else None
+    return pages, back
+
+
+@pytest.mark.parametrize("id_descending", [True, False])
+def test_pages_cover_every_row_once_in_order(ctx, tied_users, id_descending):
+    User = ctx.User
+    keys = [(User.created_at, True), (User.id, id_descending)]
+    expected = [u.id for u in User.query.filter(User.id.in_(tied_users))
+                .order_by(User.created_at.desc(), User.id.desc() if id_descending else User.id.asc())]
+    pages, back = walk(ctx, keys, tied_users, per_page=5)
+    assert [user_id for page in pages for user_id in page] == expected
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert [u.id for u in back.items] == pages[-2]
+
+
+@pytest.mark.parametrize("backwards", [False, True])
+def test_next_page_seeks_the_index(ctx, backwards):
+    User = ctx.User
+    keys = [(User.created_at, True), (User.id, True)]
+    query = User.query.filter(ctx._keyset_after(keys, [datetime(2020, 1, 1), 7], backwards))\
+                      .order_by(User.created_at.asc() if backwards else User.created_at.desc(),
+                                User.id.asc() if backwards else User.id.desc()).limit(51)
+    sql = str(query.statement.compile(ctx.db.engine, compile_kwargs={"literal_binds": True}))
+    plan = [row[-1] for row in ctx.db.session.execute(ctx.text("EXPLAIN QUERY PLAN " + sql))]
+    assert plan == ["SEARCH user USING INDEX ix_user_created_at_id (created_at%s?)" % (">" if backwards else "<")]
+
+
+def test_walking_back_ends_on_the_first_page(ctx, tied_users):
+    User = ctx.User
+    keys = [(User.created_at, True), (User.id, True)]
+    query = User.query.filter(User.id.in_(tied_users))
+    with ctx.app.test_request_context():
+        first = ctx.keyset_paginate(query, keys, per_page=5)
+        second = ctx.keyset_paginate(query, keys, first.next_cursor, per_page=5)
+        back = ctx.keyset_paginate(query, keys, second.prev_cursor, per_page=5)
+    assert not first.has_prev and second.has_prev
+    assert [u.id for u in back.items] == [u.id for u in first.items]
+    assert not back.has_prev and back.has_next
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "WyJuZXh0IiwgMV0.forged"])
+def test_bad_cursor_falls_back_to_the_first_page(ctx, tied_users, cursor):
+    User = ctx.User
+    keys = [(User.created_at, True), (User.id, True)]
+    query = User.query.filter(User.id.in_(tied_users))
+    with ctx.app.test_request_context():
+        first = ctx.keyset_paginate(query, keys, per_page=5)
+        page = ctx.keyset_paginate(query, keys, cursor, per_page=5)
+        assert ctx.decode_cursor(ctx.encode_cursor("sideways", [None, 1]), keys) == (None, None)
+        assert ctx.decode_cursor(ctx.encode_cursor("next", [1]), keys) == (None, None)
+    assert [u.id for u in page.items] == [u.id for u in first.items]
+    assert not page.has_prev
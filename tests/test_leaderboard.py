@@ -0,0 +1,64 @@
+import random
+
+
+def test_sorted_list_matches_a_plain_sorted_list(app_module):
+    class Small(app_module.SortedList):
+        LOAD = 4 # Forces frequent splits and dropped sublists
+
+    rng = random.Random(7)
+    keys = sorted(rng.sample(range(1000), 200))
+    small, expected = Small(keys), list(keys)
+    for _ in range(2000):
+        key = rng.randrange(1000)
+        if key in expected:
+            small.remove(key)
+            expected.remove(key)
+        else:
+            small.add(key)
+            expected.append(key)
+            expected.sort()
+        probe = rng.randrange(1000)
+        assert small.index(probe) == sum(1 for k in expected if k < probe)
+    assert len(small) == len(expected)
+    assert small.head(len(expected) + 5) == expected
+
+
+def test_refresh_picks_up_changes_made_by_other_processes(ctx, make_user):
+    leaderboard = ctx.leaderboard
+    leaderboard.rebuild()
+    # Another process (registration, the job worker) adds a user, credits them and renames them
+    rich_id = make_user()
+    assert leaderboard.rank(rich_id) is None
+    leaderboard.refresh()
+    assert leaderboard.rank(rich_id) is not None
+    ctx.append_ledger_entry(rich_id, "withdrawal_refund", ctx.to_micro(10 ** 9))
+    ctx.db.session.commit()
+    moved = leaderboard.refresh()
+    assert moved[rich_id] == ctx.ledger_balances([rich_id])[rich_id][0]
+    assert leaderboard.rank(rich_id) == 1
+    ctx.db.session.get(ctx.User, rich_id).display_name = "Whale"
+    ctx.db.session.commit()
+    leaderboard.refresh()
+    assert leaderboard.top(1)[0]["name"] == "Whale"
+    assert leaderboard.refresh() == {} # Nothing moved since
+
+
+def test_refresh_replays_moves_made_while_it_loads(ctx, make_user):
+    leaderboard = ctx.leaderboard
+    leaderboard.rebuild()
+    user_id = make_user()
+    ctx.append_ledger_entry(user_id, "withdrawal_refund", ctx.to_micro(5))
+    ctx.db.session.commit()
+
+    original_balances = ctx.ledger_balances
+
+    def slow_balances(user_ids):
+        balances = original_balances(user_ids)
+        leaderboard.update_many([(user_id, 42.0)]) # A flush lands while the refresh is reading
+        return balances
+    ctx.ledger_balances = slow_balances
+    try:
+        leaderboard.refresh()
+    finally:
+        ctx.ledger_balances = original_balances
+    assert leaderboard._tokens[user_id] == 42.0
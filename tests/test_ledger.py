@@ -0,0 +1,169 @@
+import pytest
+
+
+def balance(ctx, user_id):
+    return ctx.ledger_balances([user_id])[user_id]
+
+
+def withdraw(ctx, user_id, tokens):
+    withdrawal, error = ctx.create_withdrawal(user_id, tokens, "crypto", "test-address")
+    if error:
+        ctx.db.session.rollback()
+        return None, error
+    ctx.db.session.commit()
+    return withdrawal.id, None
+
+
+def test_project_tap_state_converts_every_hundred_taps():
+    from app import TAPS_PER_TOKEN, project_tap_state
+
+    assert TAPS_PER_TOKEN == 100
+    assert project_tap_state(3.0, 40, 59) == (3.0, 99)
+    assert project_tap_state(3.0, 40, 60) == (4.0, 0)
+    assert project_tap_state(0.0, 0, 250) == (2.0, 50)
+
+
+def test_flushed_taps_carry_partial_progress(ctx, make_user):
+    user_id = make_user(taps=250)
+    assert balance(ctx, user_id) == (2.0, 50)
+    ctx.tap_accumulator.add(user_id, 70)
+    ctx.tap_accumulator.flush([user_id])
+    assert balance(ctx, user_id) == (3.0, 20)
+
+
+def test_withdrawal_debits_exact_micro_amount(ctx, make_user):
+    user_id = make_user(taps=1000)
+    withdrawal_id, error = withdraw(ctx, user_id, 2.5)
+    assert error is None
+    assert balance(ctx, user_id) == (7.5, 0)
+    withdrawal = ctx.db.session.get(ctx.WithdrawalRequest, withdrawal_id)
+    assert withdrawal.status == "pending"
+    assert withdrawal.tokens_to_withdraw_micro == 2.5 * ctx.MICRO_PER_TOKEN
+    debit = ctx.LedgerEntry.query.filter_by(user_id=user_id, kind="withdrawal_debit").one()
+    assert debit.amount_micro == -2.5 * ctx.MICRO_PER_TOKEN and debit.reference_id == withdrawal_id
+
+
+def test_withdrawal_cannot_overdraw(ctx, make_user):
+    user_id = make_user(taps=550)
+    _, error = withdraw(ctx, user_id, 6)
+    assert error
+    assert balance(ctx, user_id) == (5.0, 50)
+    assert withdraw(ctx, user_id, 5)[1] is None
+    # Tap progress towards the next token is not spendable
+    assert withdraw(ctx, user_id, 0.5)[1]
+    assert balance(ctx, user_id) == (0.0, 50)
+    assert ctx.WithdrawalRequest.query.filter_by(user_id=user_id).count() == 1
+
+
+@pytest.fixture(params=[True, False], ids=["returning", "select-then-update"])
+def update_returning(request, ctx, monkeypatch):
+    # Both ways _apply_withdrawal_action claims pending requests, with and without UPDATE ... RETURNING
+    monkeypatch.setattr(ctx.db.engine.dialect, "update_returning", request.param)
+    return request.param
+
+
+def test_reject_refunds_once(ctx, make_user, update_returning):
+    user_id = make_user(taps=1000)
+    withdrawal_id, _ = withdraw(ctx, user_id, 4)
+    assert ctx.apply_withdrawal_action([withdrawal_id], "rejected", "test") == 1
+    assert ctx.apply_withdrawal_action([withdrawal_id], "rejected", "test") == 0
+    assert ctx.apply_withdrawal_action([withdrawal_id], "processed", "test") == 0
+    assert balance(ctx, user_id) == (10.0, 0)
+    refunds = ctx.LedgerEntry.query.filter_by(user_id=user_id, kind="withdrawal_refund").all()
+    assert [r.reference_id for r in refunds] == [withdrawal_id]
+
+
+def test_process_keeps_tokens_debited(ctx, make_user):
+    user_id = make_user(taps=1000)
+    withdrawal_id, _ = withdraw(ctx, user_id, 4)
+    assert ctx.apply_withdrawal_action([withdrawal_id], "processed") == 1
+    assert balance(ctx, user_id) == (6.0, 0)
+    assert ctx.db.session.get(ctx.WithdrawalRequest, withdrawal_id).status == "processed"
+
+
+def test_bulk_reject_skips_actioned_requests(ctx, make_user, monkeypatch, update_returning):
+    monkeypatch.setitem(ctx.app.config, "WITHDRAWAL_BULK_CHUNK_SIZE", 2) # Exercise several chunks
+    first, second = make_user(taps=1000), make_user(taps=1000)
+    ids = [withdraw(ctx, first, 1)[0], withdraw(ctx, first, 2)[0], withdraw(ctx, second, 3)[0],
+           withdraw(ctx, second, 1)[0]]
+    ctx.apply_withdrawal_action([ids[3]], "processed")
+    assert ctx.apply_withdrawal_action(ids, "rejected", "bulk") == 3
+    assert balance(ctx, first) == (10.0, 0)
+    assert balance(ctx, second) == (9.0, 0)
+    statuses = dict(ctx.db.session.query(ctx.WithdrawalRequest.id, ctx.WithdrawalRequest.status)
+                    .filter(ctx.WithdrawalRequest.id.in_(ids)))
+    assert [statuses[i] for i in ids] == ["rejected", "rejected", "rejected", "processed"]
+    assert ctx.LedgerEntry.query.filter(ctx.LedgerEntry.kind == "withdrawal_refund",
+                                        ctx.LedgerEntry.reference_id.in_(ids)).count() == 3
+
+
+def test_legacy_withdrawal_without_micro_amount_refunds_tokens(ctx, make_user):
+    user_id = make_user(taps=1000)
+    withdrawal_id, _ = withdraw(ctx, user_id, 3)
+    ctx.db.session.get(ctx.WithdrawalRequest, withdrawal_id).tokens_to_withdraw_micro = None
+    ctx.db.session.commit()
+    ctx.apply_withdrawal_action([withdrawal_id], "rejected")
+    assert balance(ctx, user_id) == (10.0, 0)
+
+
+def test_snapshot_folds_ledger_without_changing_balances(ctx, make_user, monkeypatch):
+    monkeypatch.setitem(ctx.app.config, "LEDGER_SNAPSHOT_LAG_SECONDS", 0)
+    monkeypatch.setitem(ctx.app.config, "LEDGER_TAP_RETENTION_DAYS", 0)
+    user_id = make_user(taps=730)
+    withdrawal_id, _ = withdraw(ctx, user_id, 2)
+    assert balance(ctx, user_id) == (5.0, 30)
+
+    ctx.snapshot_ledger()
+    snapshot = ctx.db.session.get(ctx.BalanceSnapshot, user_id)
+    assert (snapshot.balance_micro, snapshot.tap_micro) == (5 * ctx.MICRO_PER_TOKEN, 30 * ctx.MICRO_PER_TAP)
+    assert balance(ctx, user_id) == (5.0, 30)
+    user = ctx.db.session.get(ctx.User, user_id)
+    assert (user.cripto_main_tokens, user.taps_for_next_token) == (5.0, 30)
+    # Folded tap credits past the retention window are compacted; debits stay for the audit trail
+    assert ctx.LedgerEntry.query.filter_by(user_id=user_id, kind="tap_credit").count() == 0
+    assert ctx.LedgerEntry.query.filter_by(user_id=user_id, kind="withdrawal_debit").count() == 1
+
+    # Entries after the snapshot are applied on top of it
+    ctx.tap_accumulator.add(user_id, 80)
+    ctx.tap_accumulator.flush([user_id])
+    ctx.apply_withdrawal_action([withdrawal_id], "rejected")
+    assert balance(ctx, user_id) == (8.0, 10)
+    ctx.snapshot_ledger()
+    assert balance(ctx, user_id) == (8.0, 10)
+
+
+@pytest.mark.parametrize("tokens", [0.000001, 1 / 3, 12.345678])
+def test_to_micro_round_trips(tokens):
+    from app import MICRO_PER_TOKEN, to_micro
+
+    assert abs(to_micro(tokens) / MICRO_PER_TOKEN - tokens) < 1e-6
+
+
+def test_circulation_counter_tracks_the_ledger_total(ctx, make_user):
+    def totals():
+        return ctx.read_admin_stats()["tokens_in_circulation"], ctx.ledger_total_micro() / ctx.MICRO_PER_TOKEN
+
+    start_counter, start_total = totals()
+    user_id = make_user(taps=950)
+    ctx.tap_accumulator.add(user_id, 75)
+    ctx.tap_accumulator.flush([user_id])
+    rejected, _ = withdraw(ctx, user_id, 3)
+    processed, _ = withdraw(ctx, user_id, 2)
+    ctx.apply_withdrawal_action([rejected], "rejected")
+    ctx.apply_withdrawal_action([processed], "processed")
+    counter, total = totals()
+    assert total - start_total == 8.0
+    assert counter - start_counter == pytest.approx(total - start_total)
+
+
+def test_legacy_column_balance_is_the_base_without_a_snapshot(ctx, make_user):
+    user_id = make_user()
+    user = ctx.db.session.get(ctx.User, user_id)
+    user.cripto_main_tokens, user.taps_for_next_token = 3.5, 80
+    ctx.db.session.commit()
+    assert balance(ctx, user_id) == (3.5, 80)
+    ctx.tap_accumulator.add(user_id, 30)
+    ctx.tap_accumulator.flush([user_id])
+    assert balance(ctx, user_id) == (4.5, 10)
+    assert withdraw(ctx, user_id, 4)[1] is None
+    assert balance(ctx, user_id) == (0.5, 10)
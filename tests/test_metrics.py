@@ -0,0 +1,17 @@
+def gauge(body, name):
+    return next(float(line.split()[-1]) for line in body.splitlines() if line.startswith(name + " "))
+
+
+def test_metrics_report_tap_buffer_and_open_streams(app_module, make_user):
+    app_module.tap_accumulator.flush()
+    user_id = make_user()
+    app_module.tap_accumulator.add(user_id, 3)
+    subscriber = app_module.event_hub.subscribe(user_id)
+    try:
+        body = app_module.app.test_client().get("/metrics").get_data(as_text=True)
+    finally:
+        app_module.event_hub.unsubscribe(subscriber)
+        app_module.tap_accumulator.flush()
+    assert gauge(body, "criptomain_tap_buffer_users") == 1
+    assert gauge(body, "criptomain_sse_streams") == 1
+    assert app_module.event_hub.stream_count() == 0
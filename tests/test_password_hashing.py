@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import signal
+from types import SimpleNamespace
+
+import pytest
+
+
+def make_hasher(app_module, workers=1):
+    return app_module.PasswordHasher(SimpleNamespace(config={
+        "PASSWORD_HASH_WORKERS": workers,
+        "PASSWORD_HASH_MAX_PENDING": 4,
+        "PASSWORD_HASH_TIMEOUT_SECONDS": 10.0,
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000",
+    }))
+
+
+def test_inline_hasher_round_trips(app_module):
+    hasher = make_hasher(app_module, workers=0)
+    pwhash = hasher.hash("secret")
+    assert hasher.verify(pwhash, "secret") and not hasher.verify(pwhash, "wrong")
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="pool uses fork")
+def test_pool_is_rebuilt_after_a_worker_dies(app_module):
+    hasher = make_hasher(app_module)
+    try:
+        hasher.warm()
+        pwhash = hasher.hash("secret")
+        for pid in list(hasher._executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        assert hasher.verify(pwhash, "secret")
+        assert hasher.verify(pwhash, "secret")
+        assert "criptomain_password_hash_pool_restarts_total 1" in hasher.render_metrics()
+    finally:
+        hasher.shutdown()
+
+
+def test_full_queue_is_refused(app_module):
+    hasher = make_hasher(app_module, workers=0)
+    hasher.app.config["PASSWORD_HASH_MAX_PENDING"] = 0
+    with pytest.raises(app_module.PasswordHasherBusy):
+        hasher.hash("secret")
+    assert "criptomain_password_hash_rejected_total 1" in hasher.render_metrics()
+
+
+def test_hash_method_is_normalized_like_werkzeug(app_module):
+    from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+
+    assert app_module.normalize_hash_method("scrypt") == "scrypt:32768:8:1"
+    assert app_module.normalize_hash_method("pbkdf2") == f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}"
+    assert app_module.normalize_hash_method("pbkdf2:sha512") == f"pbkdf2:sha512:{DEFAULT_PBKDF2_ITERATIONS}"
+    assert app_module.normalize_hash_method("pbkdf2:sha256:1000") == "pbkdf2:sha256:1000"
+
+
+def test_login_upgrades_a_hash_made_with_an_older_cost(app_module, make_user):
+    from werkzeug.security import generate_password_hash
+
+    user_id = make_user()
+    user = app_module.db.session.get(app_module.User, user_id)
+    user.password_hash = generate_password_hash("old-password", "pbkdf2:sha256:500")
+    app_module.db.session.commit()
+    assert app_module.password_needs_rehash(user.password_hash)
+
+    assert user.check_password("old-password")
+    app_module.db.session.commit()
+    assert user.password_hash.startswith("pbkdf2:sha256:1000$")
+    assert not app_module.password_needs_rehash(user.password_hash)
+    assert user.check_password("old-password") and not user.check_password("wrong")
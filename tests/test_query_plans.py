@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_request_paths_use_indexes_and_deep_pages_seek():
+    # query_plans.py creates its own application, and app.py allows one per process
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "query_plans.py"), "--users", "1000"],
+                            cwd=ROOT, capture_output=True, text=True, timeout=300)
+    summary = [line for line in result.stdout.splitlines() if not line.startswith("ok ")]
+    assert result.returncode == 0, "\n".join(summary)
@@ -0,0 +1,78 @@
+import pytest
+
+
+@pytest.fixture
+def limited(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, "TAP_RATE_LIMIT_ENABLED", True)
+    monkeypatch.setitem(app_module.app.config, "TAP_RATE_USER_BURST", 60)
+    monkeypatch.setitem(app_module.app.config, "TAP_RATE_USER_PER_SECOND", 1.0)
+    return app_module
+
+
+def test_batch_larger_than_burst_is_a_400_not_a_429(limited, client):
+    response = client.post("/api/record_taps", json={"count": 100})
+    assert response.status_code == 400
+    assert response.get_json()["max_batch"] == 60
+    assert "Retry-After" not in response.headers
+
+
+def test_bucket_admits_burst_then_asks_to_retry(limited, client):
+    assert client.post("/api/record_taps", json={"count": 60}).status_code == 200
+    response = client.post("/api/record_taps", json={"count": 10})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_batch_cap_without_limiter_is_tap_max_batch(app_module, client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, "TAP_MAX_BATCH", 500)
+    assert client.post("/api/record_taps", json={"count": 500}).status_code == 200
+    assert client.post("/api/record_taps", json={"count": 501}).status_code == 400
+
+
+def test_bucket_refills_at_its_rate(app_module, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(app_module.time, "monotonic", lambda: clock[0])
+    limiter = app_module.TokenBucketLimiter()
+    assert limiter.consume("user:1", 10, rate=2.0, burst=10) == 0
+    assert limiter.consume("user:1", 4, rate=2.0, burst=10) == 2.0 # 4 taps short at 2 per second
+    clock[0] += 1.5
+    assert limiter.consume("user:1", 3, rate=2.0, burst=10) == 0
+    clock[0] += 3600
+    assert limiter.consume("user:1", 10, rate=2.0, burst=10) == 0 # Refill stops at the burst
+    assert limiter.consume("user:1", 1, rate=2.0, burst=10) > 0
+
+
+def test_idle_buckets_are_pruned(app_module, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(app_module.time, "monotonic", lambda: clock[0])
+    limiter = app_module.TokenBucketLimiter()
+    limiter._prune_at = 3
+    for key in ("a", "b", "c"):
+        limiter.consume(key, 1, rate=1.0, burst=5)
+    clock[0] += 10 # Every bucket has refilled
+    limiter.consume("d", 1, rate=1.0, burst=5)
+    assert set(limiter._buckets) == {"d"}
+
+
+def test_ip_limit_spans_users(app_module, monkeypatch):
+    config = app_module.app.config
+    monkeypatch.setitem(config, "TAP_RATE_USER_BURST", 50)
+    monkeypatch.setitem(config, "TAP_RATE_IP_BURST", 80)
+    monkeypatch.setitem(config, "TAP_RATE_LIMIT_BACKEND", "memory")
+    limiter = app_module.TapRateLimiter(app_module.app)
+    assert limiter.check(1, "10.0.0.1", 50) == 0
+    assert limiter.check(2, "10.0.0.1", 30) == 0
+    assert limiter.check(3, "10.0.0.1", 1) > 0 # Fresh user, spent IP bucket
+    assert limiter.check(3, "10.0.0.2", 1) == 0
+
+
+def test_shared_store_limits_across_workers(app_module, tmp_path):
+    from sqlalchemy import create_engine
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'buckets.db'}")
+    app_module.RateLimitBucket.__table__.create(engine)
+    worker_a, worker_b = app_module.SharedBucketStore(lambda: engine), app_module.SharedBucketStore(lambda: engine)
+    assert worker_a.consume("user:1", 40, rate=1.0, burst=60) == 0
+    assert worker_b.consume("user:1", 20, rate=1.0, burst=60) == 0
+    assert worker_a.consume("user:1", 10, rate=1.0, burst=60) > 0
+    engine.dispose()
@@ -0,0 +1,43 @@
+import contextlib
+
+from sqlalchemy import event
+
+
+@contextlib.contextmanager
+def count_statements(app_module):
+    with app_module.app.app_context():
+        engine = app_module.db.engine
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+
+def tap(client, count, seq):
+    response = client.post("/api/record_taps", json={"count": count, "seq": seq})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_taps_after_the_first_do_not_touch_the_database(app_module, client):
+    tap(client, 150, 1) # First sight: balance and last seq are read once
+    with count_statements(app_module) as statements:
+        body = tap(client, 60, 2)
+    assert statements == []
+    assert (body["cripto_main_tokens"], body["taps_for_next_token"]) == (2.0, 10)
+    assert body["tokens_earned_this_tap"] == 1.0
+    app_module.tap_accumulator.flush()
+    assert tap(client, 95, 3)["cripto_main_tokens"] == 3.0 # Cache refreshed by the flush, no double count
+
+
+def test_withdrawal_refreshes_the_cached_balance(app_module, client):
+    tap(client, 500, 1)
+    response = client.post("/api/request_withdrawal", json={
+        "tokens_to_withdraw": 2, "payment_method": "crypto", "payment_details": "test"})
+    assert response.get_json()["new_token_balance"] == 3.0
+    assert tap(client, 100, 2)["cripto_main_tokens"] == 4.0